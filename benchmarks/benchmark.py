@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+""" Offline benchmarks of the CDF conversion, browse generation and
+    graticule scripts.
+
+The benchmarks run on synthetic fixtures: Swarm-like CDF files, LineString
+and MultiLineString shapefiles and scaled-down QD grids. Each stage runs in
+its own process so that its peak RSS is measured in isolation. The results
+are written as JSON and can be compared with the results of an earlier run:
+
+    ./benchmark.py --output before.json
+    ./benchmark.py --output after.json --baseline before.json --threshold 0.2
+"""
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import traceback
+from argparse import ArgumentParser
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+from os.path import join, dirname, abspath, exists
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, "graticules"))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+
+# CDF_EPOCH values are milliseconds since 0000-01-01T00:00:00
+CDF_EPOCH_1970 = 62167219200000.0
+# start of the synthetic data, 2016-01-01T00:00:00
+START_TIME = 1451606400.0
+# Swarm orbital period and inclination
+ORBIT_PERIOD = 5640.0
+INCLINATION = 87.35
+
+
+class Fixtures(object):
+    """ Synthetic input files of the benchmarks created in `directory`. """
+
+    def __init__(self, directory, records=86400, chunksize=1000,
+                 features=1000, vertices=200, grid_size_x=721,
+                 grid_size_y=361, interval=10, epoch=2016.0):
+        self.directory = directory
+        self.records = records
+        self.chunksize = chunksize
+        self.features = features
+        self.vertices = vertices
+        self.grid_size_x = grid_size_x
+        self.grid_size_y = grid_size_y
+        self.interval = interval
+        self.epoch = epoch
+        self.cdf_filename = join(
+            directory, "SW_OPER_MAGA_LR_1B_20160101T000000_BENCH.cdf"
+        )
+        self.shapefile_filename = join(directory, "lines.shp")
+        self.qd_grid_filename = join(directory, "qd_grid.npz")
+        self.output_dir = join(directory, "output")
+
+    def options(self):
+        """ Get the fixture parameters recorded with the results. """
+        return {
+            "records": self.records, "chunksize": self.chunksize,
+            "features": self.features, "vertices": self.vertices,
+            "grid_size_x": self.grid_size_x, "grid_size_y": self.grid_size_y,
+            "interval": self.interval, "epoch": self.epoch,
+        }
+
+    def prepare(self, names):
+        """ Create the named fixtures unless they exist already. """
+        if not exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        if "cdf" in names and not exists(self.cdf_filename):
+            make_cdf(self.cdf_filename, self.records)
+        if "shapefile" in names and not exists(self.shapefile_filename):
+            make_shapefile(
+                self.shapefile_filename, self.features, self.vertices
+            )
+        if "qd_grid" in names and not exists(self.qd_grid_filename):
+            make_qd_grid(
+                self.qd_grid_filename, self.grid_size_x, self.grid_size_y,
+                self.epoch
+            )
+
+    def chunk_bounds(self):
+        return [
+            (start, min(start + self.chunksize, self.records))
+            for start in xrange(0, self.records - 1, self.chunksize)
+            if min(start + self.chunksize, self.records) - start >= 2
+        ]
+
+    def qd_grid(self):
+        with np.load(self.qd_grid_filename) as data:
+            return data["qd_lat"], data["qd_lon"]
+
+
+def swarm_orbit(records, seed=0):
+    """ Get 1 Hz times and lons, lats, radii and F of a synthetic polar orbit
+        with a dipole-like field intensity plus noise.
+    """
+    random = np.random.RandomState(seed)
+    seconds = np.arange(records, dtype="float64")
+    phase = 2 * np.pi * seconds / ORBIT_PERIOD
+    lats = np.degrees(np.arcsin(np.sin(np.radians(INCLINATION)) * np.sin(phase)))
+    lons = np.degrees(np.arctan2(
+        np.cos(np.radians(INCLINATION)) * np.sin(phase), np.cos(phase)
+    ))
+    # the Earth rotates below the orbit
+    lons = np.mod(lons - seconds * (360.0 / 86400) + 180, 360) - 180
+    radii = 6833000.0 + 15000 * np.sin(phase / 3.0)
+    f = 22000 * np.sqrt(1 + 3 * np.sin(np.radians(lats)) ** 2)
+    f += random.normal(0, 5, records)
+    return START_TIME + seconds, lons, lats, radii, f
+
+
+def make_cdf(filename, records):
+    """ Write a Swarm MAG LR like CDF with `records` 1 Hz records. """
+    from spacepy import pycdf
+
+    times, lons, lats, radii, f = swarm_orbit(records)
+    cdf = pycdf.CDF(filename, "")
+    try:
+        cdf.new("Timestamp", type=pycdf.const.CDF_EPOCH)
+        cdf.raw_var("Timestamp")[:] = times * 1000 + CDF_EPOCH_1970
+        cdf["Latitude"] = lats
+        cdf["Longitude"] = lons
+        cdf["Radius"] = radii
+        cdf["F"] = f
+        b_nec = np.empty((records, 3))
+        b_nec[:, 0] = f * np.cos(np.radians(lats))
+        b_nec[:, 1] = 0.01 * f
+        b_nec[:, 2] = f * np.sin(np.radians(lats))
+        cdf["B_NEC"] = b_nec
+    finally:
+        cdf.close()
+
+
+def random_line(random, vertices):
+    """ Get a random walk line of `vertices` vertices. The walk may cross the
+        antimeridian, longitudes are wrapped to [-180, 180).
+    """
+    start = [random.uniform(-180, 180), random.uniform(-70, 70)]
+    steps = random.normal(0, 0.2, (vertices, 2))
+    steps[0] = 0
+    coords = start + np.cumsum(steps, axis=0)
+    coords[:, 0] = np.mod(coords[:, 0] + 180, 360) - 180
+    coords[:, 1] = np.clip(coords[:, 1], -89.9, 89.9)
+    # a wrapped segment would span the whole map
+    jumps = np.flatnonzero(np.abs(np.diff(coords[:, 0])) > 180) + 1
+    return [part.tolist() for part in np.split(coords, jumps) if len(part) > 1]
+
+
+def make_shapefile(filename, features, vertices, seed=0):
+    """ Write `features` LineString and MultiLineString features with about
+        `vertices` vertices each. Every third feature has three parts.
+    """
+    import fiona
+
+    random = np.random.RandomState(seed)
+    schema = {"geometry": "LineString", "properties": {"id": "int"}}
+    with fiona.open(filename, "w", driver="ESRI Shapefile", schema=schema,
+                    crs={"init": "epsg:4326"}) as dst:
+        for i in xrange(features):
+            count, size = (3, max(2, vertices // 3)) if i % 3 == 2 else (
+                1, vertices)
+            parts = []
+            for _ in xrange(count):
+                parts.extend(random_line(random, size))
+            if not parts:
+                continue
+            if len(parts) == 1:
+                geometry = {"type": "LineString", "coordinates": parts[0]}
+            else:
+                geometry = {"type": "MultiLineString", "coordinates": parts}
+            dst.write({"geometry": geometry, "properties": {"id": i}})
+
+
+def make_qd_grid(filename, size_x, size_y, epoch):
+    """ Evaluate a scaled-down QD grid and store it as .npz. """
+    from qdgrid import eval_qd_grid, BOUNDS
+
+    qd_lat, qd_lon = eval_qd_grid(size_x, size_y, BOUNDS, 0, epoch)
+    np.savez(filename, qd_lat=qd_lat, qd_lon=qd_lon)
+
+
+def count_vertices(geometry):
+    """ Count the vertices of a GeoJSON-like (Multi)LineString. """
+    if geometry["type"] == "LineString":
+        return len(geometry["coordinates"])
+    return sum(len(part) for part in geometry["coordinates"])
+
+
+# Each stage function sets up its inputs and returns a callable running the
+# timed part and the number of items processed by one call.
+
+def bench_cdf_read(fixtures):
+    from spacepy import pycdf
+    from generate_browse import ChunkReader
+
+    bounds = fixtures.chunk_bounds()
+
+    def run():
+        reader = ChunkReader(pycdf.CDF(fixtures.cdf_filename))
+        for _ in reader.chunks(bounds):
+            pass
+    return run, fixtures.records
+
+
+def read_chunks(fixtures):
+    from spacepy import pycdf
+    from generate_browse import ChunkReader
+
+    reader = ChunkReader(pycdf.CDF(fixtures.cdf_filename))
+    return list(reader.chunks(fixtures.chunk_bounds()))
+
+
+def bench_render(fixtures):
+    from generate_browse import to_array
+
+    chunks = read_chunks(fixtures)
+
+    def run():
+        for _, _, _, _, f in chunks:
+            to_array(f, 1000, 104)
+    return run, fixtures.records
+
+
+def bench_tiff_write(fixtures):
+    from generate_browse import to_array, write_tiff
+
+    images = [to_array(f, 1000, 104) for _, _, _, _, f in read_chunks(fixtures)]
+    template = join(fixtures.output_dir, "tiff_%d.tif")
+
+    def run():
+        for i, image in enumerate(images):
+            write_tiff(template % i, image)
+    return run, len(images)
+
+
+def bench_report_write(fixtures):
+    from generate_browse import browse_report, write_report
+
+    chunks = read_chunks(fixtures)
+    template = join(fixtures.output_dir, "report_%d")
+
+    def run():
+        for i, (start_time, end_time, lons, lats, _) in enumerate(chunks):
+            write_report(template % i + ".xml", "SW_OPER_MAGA_LR_1B", [
+                browse_report(
+                    template % i + ".tif", start_time, end_time, lons, lats
+                )
+            ])
+    return run, len(chunks)
+
+
+def bench_generate(fixtures):
+    from generate_browse import generate
+
+    template = join(fixtures.output_dir, "browse_%s.tif")
+
+    def run():
+        generate(fixtures.cdf_filename, template, step=fixtures.chunksize)
+    return run, fixtures.records
+
+
+def bench_convert(fixtures):
+    from convert import convert
+
+    output_filename = join(fixtures.output_dir, "convert.csv")
+
+    def run():
+        convert(fixtures.cdf_filename, output_filename)
+    return run, fixtures.records
+
+
+def bench_convert_chunked(fixtures):
+    from convert import convert_chunked
+
+    output_filename = join(fixtures.output_dir, "convert_chunked.csv")
+
+    def run():
+        convert_chunked(fixtures.cdf_filename, output_filename)
+    return run, fixtures.records
+
+
+def bench_qd_eval(fixtures):
+    from qdgrid import eval_qd_grid, BOUNDS
+
+    def run():
+        eval_qd_grid(
+            fixtures.grid_size_x, fixtures.grid_size_y, BOUNDS, 0,
+            fixtures.epoch
+        )
+    return run, fixtures.grid_size_x * fixtures.grid_size_y
+
+
+def bench_contour(fixtures):
+    from qd_warp import extract_contours, BOUNDS
+
+    qd_lat, qd_lon = fixtures.qd_grid()
+    abs_lon = np.absolute(qd_lon)
+
+    def run():
+        for array in (qd_lat, abs_lon, qd_lon):
+            for _ in extract_contours(
+                    array, BOUNDS, fixtures.interval, "dd", 0):
+                pass
+    return run, qd_lat.size
+
+
+def bench_split_longitudes(fixtures):
+    from affine import Affine
+    from qd_warp import extract_contours, _extract_longitudes, BOUNDS
+
+    qd_lat, qd_lon = fixtures.qd_grid()
+    left, bottom, right, top = BOUNDS
+    size_y, size_x = qd_lon.shape
+    affine = Affine.translation(left, top) * Affine.scale(
+        (right - left) / float(size_x), -(top - bottom) / float(size_y)
+    )
+    lon_lines = list(extract_contours(
+        np.absolute(qd_lon), BOUNDS, fixtures.interval, "dd", 0
+    ))
+
+    def run():
+        for _ in _extract_longitudes(lon_lines, qd_lon, affine):
+            pass
+    return run, sum(count_vertices(line["geometry"]) for line in lon_lines)
+
+
+def bench_qd_warp(fixtures):
+    import qd_warp
+
+    output_filename = join(fixtures.output_dir, "graticules.shp")
+    args = [
+        output_filename, str(fixtures.interval),
+        "--size_x", str(fixtures.grid_size_x),
+        "--size_y", str(fixtures.grid_size_y),
+        "--epoch", str(fixtures.epoch),
+    ]
+
+    def run():
+        qd_warp.main(args)
+    return run, fixtures.grid_size_x * fixtures.grid_size_y
+
+
+def read_shapefile(fixtures):
+    import fiona
+
+    with fiona.open(fixtures.shapefile_filename) as src:
+        return [feature["geometry"] for feature in src]
+
+
+def bench_warp(fixtures):
+    from shapely.geometry import shape
+    from warp import warp_geometry
+
+    geometries = read_shapefile(fixtures)
+    geoms = [shape(geometry) for geometry in geometries]
+
+    def run():
+        for geom in geoms:
+            warp_geometry(geom, fixtures.epoch)
+    return run, sum(count_vertices(geometry) for geometry in geometries)
+
+
+def bench_warp_main(fixtures):
+    import warp
+
+    geometries = read_shapefile(fixtures)
+    args = [
+        fixtures.shapefile_filename,
+        join(fixtures.output_dir, "warped.shp"),
+        "--epoch", str(fixtures.epoch), "--progress_interval", "1e9",
+    ]
+
+    def run():
+        warp.main(args)
+    return run, sum(count_vertices(geometry) for geometry in geometries)
+
+
+# (name, fixture, unit, function)
+STAGES = [
+    ("cdf_read", "cdf", "records", bench_cdf_read),
+    ("render", "cdf", "records", bench_render),
+    ("tiff_write", "cdf", "images", bench_tiff_write),
+    ("report_write", "cdf", "reports", bench_report_write),
+    ("generate", "cdf", "records", bench_generate),
+    ("convert", "cdf", "records", bench_convert),
+    ("convert_chunked", "cdf", "records", bench_convert_chunked),
+    ("qd_eval", None, "points", bench_qd_eval),
+    ("contour", "qd_grid", "points", bench_contour),
+    ("split_longitudes", "qd_grid", "vertices", bench_split_longitudes),
+    ("qd_warp", None, "points", bench_qd_warp),
+    ("warp", "shapefile", "vertices", bench_warp),
+    ("warp_main", "shapefile", "vertices", bench_warp_main),
+]
+
+STAGE_NAMES = [name for name, _, _, _ in STAGES]
+
+
+def peak_rss():
+    """ Get the peak resident set size of this process in kB. """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss // 1024 if sys.platform == "darwin" else maxrss
+
+
+def _run_stage(task):
+    """ Set up and run one stage `repeat` times in a worker process. """
+    name, fixtures, repeat = task
+    function = dict((name_, f) for name_, _, _, f in STAGES)[name]
+    try:
+        run, items = function(fixtures)
+        times = []
+        for _ in xrange(repeat):
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+    except Exception:
+        return {"error": traceback.format_exc().strip().splitlines()[-1]}
+    return {"times": times, "items": items, "peak_rss_kb": peak_rss()}
+
+
+def run_stages(fixtures, names, repeat=3):
+    """ Run the named stages, each in a fresh process, and get their results
+        keyed by the stage name. The best time of the repeats is used.
+    """
+    units = dict((name, unit) for name, _, unit, _ in STAGES)
+    results = {}
+    for name in names:
+        pool = Pool(1)
+        try:
+            result = pool.apply(_run_stage, ((name, fixtures, repeat),))
+        finally:
+            pool.close()
+            pool.join()
+        if "times" in result:
+            seconds = min(result["times"])
+            result.update(
+                seconds=seconds, unit=units[name],
+                throughput=result["items"] / max(seconds, 1e-9),
+            )
+            sys.stderr.write("%-18s %10.4fs %14.1f %s/s %10d kB\n" % (
+                name, seconds, result["throughput"], units[name],
+                result["peak_rss_kb"]
+            ))
+        else:
+            sys.stderr.write("%-18s FAILED: %s\n" % (name, result["error"]))
+        results[name] = result
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Get the `(name, baseline seconds, seconds)` of the stages more than
+        `threshold` (a fraction) slower than in the baseline. Stages which
+        processed a different number of items are not comparable and skipped.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        reference = baseline.get(name)
+        if not reference or "seconds" not in reference or (
+                "seconds" not in result):
+            continue
+        if reference["items"] != result["items"]:
+            sys.stderr.write(
+                "%s: not compared, %d %s in the baseline, %d now\n" % (
+                    name, reference["items"], result["unit"], result["items"]
+                )
+            )
+            continue
+        ratio = result["seconds"] / max(reference["seconds"], 1e-9)
+        sys.stderr.write("%-18s %+7.1f%%\n" % (name, (ratio - 1) * 100))
+        if ratio > 1 + threshold:
+            regressions.append((name, reference["seconds"], result["seconds"]))
+    return regressions
+
+
+def main(args=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument("--stages", default=",".join(STAGE_NAMES),
+        help="Comma separated list of the benchmarked stages: %s" %
+             ", ".join(STAGE_NAMES)
+    )
+    parser.add_argument("--records", type=int, default=86400,
+        help="Number of 1 Hz records of the synthetic CDF file."
+    )
+    parser.add_argument("--chunksize", type=int, default=1000,
+        help="Number of records per browse chunk."
+    )
+    parser.add_argument("--features", type=int, default=1000,
+        help="Number of features of the synthetic shapefile."
+    )
+    parser.add_argument("--vertices", type=int, default=200,
+        help="Number of vertices per synthetic feature."
+    )
+    parser.add_argument("--grid-size-x", type=int, default=721,
+        help="Width of the QD grids."
+    )
+    parser.add_argument("--grid-size-y", type=int, default=361,
+        help="Height of the QD grids."
+    )
+    parser.add_argument("--interval", type=int, default=10,
+        help="Graticule interval in degrees."
+    )
+    parser.add_argument("--epoch", type=float, default=2016.0,
+        help="Decimal year of the QD model evaluations."
+    )
+    parser.add_argument("--repeat", "-r", type=int, default=3,
+        help="Number of timed runs per stage, the best one is reported."
+    )
+    parser.add_argument("--output", "-o", default="benchmark.json",
+        help="Results file."
+    )
+    parser.add_argument("--baseline", "-b", default=None,
+        help="Results file of an earlier run to compare with."
+    )
+    parser.add_argument("--threshold", "-t", type=float, default=0.2,
+        help="Fail when a stage is slower than in the baseline by more than "
+             "this fraction."
+    )
+    parser.add_argument("--dir", "-d", default=None,
+        help="Directory of the fixtures, kept between runs. A temporary "
+             "directory is used and removed by default."
+    )
+    parsed = parser.parse_args(args)
+
+    names = [name for name in parsed.stages.split(",") if name]
+    unknown = set(names) - set(STAGE_NAMES)
+    if unknown:
+        parser.error("unknown stages: %s" % ", ".join(sorted(unknown)))
+
+    directory = parsed.dir or tempfile.mkdtemp(prefix="benchmark_")
+    fixtures = Fixtures(
+        directory, parsed.records, parsed.chunksize, parsed.features,
+        parsed.vertices, parsed.grid_size_x, parsed.grid_size_y,
+        parsed.interval, parsed.epoch
+    )
+    try:
+        fixtures.prepare(set(
+            fixture for name, fixture, _, _ in STAGES if name in names
+        ))
+        results = run_stages(fixtures, names, parsed.repeat)
+    finally:
+        if parsed.dir is None:
+            shutil.rmtree(directory)
+
+    with open(parsed.output, "w") as f:
+        json.dump({
+            "created": datetime.utcnow().isoformat("T") + "Z",
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "cpus": cpu_count(),
+            "options": dict(fixtures.options(), repeat=parsed.repeat),
+            "stages": results,
+        }, f, indent=2, sort_keys=True)
+
+    failed = [name for name in names if "error" in results[name]]
+    regressions = []
+    if parsed.baseline:
+        with open(parsed.baseline) as f:
+            baseline = json.load(f)["stages"]
+        regressions = compare(results, baseline, parsed.threshold)
+        for name, before, after in regressions:
+            sys.stderr.write("REGRESSION %s: %.4fs -> %.4fs\n" % (
+                name, before, after
+            ))
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,45 @@
 import sys
-from argparse import ArgumentParser
-from itertools import izip
+import os
 import csv
+import glob
+import time
+import traceback
+from argparse import ArgumentParser
+from bisect import bisect_left
+from datetime import datetime
+from itertools import izip, imap
+from multiprocessing import Pool
+from os.path import join, basename, isdir, exists, getmtime, splitext
 
 import numpy as np
 from spacepy import pycdf
-from matplotlib import pyplot as plt
-from lxml import etree
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# CDF_EPOCH values are milliseconds since 0000-01-01T00:00:00
+CDF_EPOCH_1970 = 62167219200000.0
+
+TIME_TYPES = (
+    pycdf.const.CDF_EPOCH.value,
+    pycdf.const.CDF_EPOCH16.value,
+    pycdf.const.CDF_TIME_TT2000.value,
+)
+
+DEFAULT_VARIABLES = ("Timestamp", "Longitude", "Latitude", "Radius", "F")
+DEFAULT_HEADER = ("timestamp", "lon", "lat", "radius", "f")
+
+# component labels of the vector variables, others are numbered
+COMPONENTS = {
+    "B_NEC": ("N", "E", "C"),
+}
+
+FORMATS = ("csv", "npz", "parquet")
+EXTENSIONS = {"csv": ".csv", "npz": ".npz", "parquet": ".parquet"}
 
 
 def convert(input_filename, output_filename):
@@ -17,11 +50,367 @@ def convert(input_filename, output_filename):
 
     with open(output_filename, "w+") as f:
         writer = csv.writer(f)
-        
+
         writer.writerow(("timestamp", "lon", "lat", "radius", "f"))
         for timestamp, lon, lat, radius, f in values:
             writer.writerow((timestamp.isoformat("T"), lon, lat, radius, f))
 
 
+def convert_chunked(input_filename, output_filename, chunksize=65536,
+                    variables=None, start=None, end=None, format="csv"):
+    """ Streaming variant of `convert`. The records are read in blocks of
+        `chunksize` and each block is formatted in one go. With the default
+        arguments the output is identical to the one written by `convert`.
+
+        `variables` selects the CDF variables to export, vector variables are
+        split into one column per component. `start` and `end` restrict the
+        export to the records with `start <= Timestamp < end`.
+
+        A `chunksize` of 0 selects the record by record writer `convert`,
+        which supports the default CSV export only.
+    """
+    if format not in FORMATS:
+        raise ValueError("Unsupported output format: %s" % format)
+
+    if chunksize <= 0:
+        if variables is not None or start is not None or end is not None \
+                or format != "csv":
+            raise ValueError(
+                "The record by record writer supports the default CSV "
+                "export only."
+            )
+        return convert(input_filename, output_filename)
+
+    cdf = pycdf.CDF(input_filename)
+    if variables is None:
+        variables, header = DEFAULT_VARIABLES, DEFAULT_HEADER
+    else:
+        header = column_names(cdf, variables)
+
+    first, last = select_range(cdf, start, end)
+    if first == last:
+        # keep the column types of an empty selection
+        blocks = iter([empty_block(cdf, variables)])
+    else:
+        blocks = iter_blocks(cdf, variables, first, last, chunksize)
+
+    if format == "csv":
+        write_csv(output_filename, header, blocks)
+    elif format == "npz":
+        write_npz(output_filename, header, blocks)
+    else:
+        write_parquet(output_filename, header, blocks)
+
+
+def select_range(cdf, start=None, end=None, name="Timestamp"):
+    """ Get the record range `[first, last)` with `start <= time < end`.
+        The range is located by a binary search over the sorted time variable
+        so that only a few records are read.
+    """
+    var = cdf[name]
+    first = 0 if start is None else bisect_left(var, start)
+    last = len(var) if end is None else bisect_left(var, end)
+    return first, max(first, last)
+
+
+def column_names(cdf, variables):
+    """ Get the output column names. Vector variables get one column per
+        component, labelled from the `COMPONENTS` table, e.g., B_NEC is split
+        into B_NEC_N, B_NEC_E and B_NEC_C, or numbered from 0 otherwise.
+    """
+    names = []
+    for variable in variables:
+        shape = cdf[variable].shape[1:]
+        size = int(np.prod(shape))
+        if not shape:
+            names.append(variable)
+            continue
+        labels = COMPONENTS.get(variable)
+        if labels is None or len(labels) != size:
+            labels = [str(i) for i in xrange(size)]
+        names.extend("%s_%s" % (variable, label) for label in labels)
+    return names
+
+
+def iter_blocks(cdf, variables, first, last, chunksize):
+    """ Read the records `[first, last)` of the given variables in blocks of
+        `chunksize` records. Each block is a list of 1D column arrays.
+    """
+    for chunk_start in xrange(first, last, chunksize):
+        chunk_end = min(chunk_start + chunksize, last)
+        columns = []
+        for variable in variables:
+            if cdf[variable].type() in TIME_TYPES:
+                columns.append(
+                    read_timestamps(cdf, variable, chunk_start, chunk_end)
+                )
+                continue
+            data = cdf[variable][chunk_start:chunk_end]
+            data = data.reshape((len(data), -1))
+            columns.extend(data[:, i] for i in xrange(data.shape[1]))
+        yield columns
+
+
+def empty_block(cdf, variables):
+    """ Get a block of empty columns with the types of the variables. """
+    columns = []
+    for variable in variables:
+        var = cdf[variable]
+        if var.type() in TIME_TYPES:
+            columns.append(np.empty(0, dtype="datetime64[us]"))
+            continue
+        size = int(np.prod(var.shape[1:]))
+        columns.extend(np.empty(0, dtype=var.dtype) for _ in xrange(size))
+    return columns
+
+
+def read_timestamps(cdf, name, start, stop):
+    """ Read a slice of a time variable as a numpy datetime64[us] array.
+        CDF_EPOCH variables are converted from their raw values without
+        creating any datetime objects.
+    """
+    var = cdf[name]
+    if var.type() == pycdf.const.CDF_EPOCH.value:
+        raw = cdf.raw_var(name)[start:stop]
+        return np.round(
+            (np.asarray(raw) - CDF_EPOCH_1970) * 1000
+        ).astype("int64").astype("datetime64[us]")
+    return np.array(var[start:stop], dtype="datetime64[us]")
+
+
+def format_timestamps(times):
+    """ Format datetime64[us] values the same way as
+        `datetime.isoformat("T")` does, i.e. the fraction of second is only
+        printed when it is not zero.
+    """
+    whole = (times.astype("int64") % 1000000) == 0
+    return np.where(
+        whole,
+        np.datetime_as_string(times, unit="s"),
+        np.datetime_as_string(times, unit="us"),
+    ).tolist()
+
+
+def format_column(column):
+    """ Format a column the same way as `csv.writer` does, i.e., Python
+        floats (float64) with `repr` and other NumPy scalars with `str`.
+    """
+    if column.dtype.kind == "M":
+        return format_timestamps(column)
+    elif column.dtype == np.float64:
+        return map(repr, column.tolist())
+    elif column.dtype.kind == "f":
+        return map(str, column)
+    return map(str, column.tolist())
+
+
+def write_csv(filename, header, blocks):
+    with open(filename, "w+") as f:
+        f.write(",".join(header) + "\r\n")
+        for columns in blocks:
+            if not len(columns[0]):
+                continue
+            f.write("\r\n".join(
+                imap(",".join, izip(*map(format_column, columns)))
+            ))
+            f.write("\r\n")
+
+
+def write_npz(filename, header, blocks):
+    """ Write the columns as named arrays of a NumPy .npz file. """
+    columns = [np.concatenate(parts) for parts in izip(*blocks)]
+    with open(filename, "wb") as f:
+        np.savez(f, **dict(izip(header, columns)))
+
+
+def write_parquet(filename, header, blocks):
+    """ Write the columns to a Parquet file, one row group per block. """
+    if pyarrow is None:
+        raise ImportError("Parquet output requires the pyarrow package.")
+    writer = None
+    try:
+        for columns in blocks:
+            table = pyarrow.Table.from_arrays(
+                [pyarrow.array(column) for column in columns], list(header)
+            )
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(filename, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def find_inputs(patterns):
+    """ Expand the input directories and glob patterns to a sorted list of
+        CDF files.
+    """
+    filenames = set()
+    for pattern in patterns:
+        if isdir(pattern):
+            pattern = join(pattern, "*.[cC][dD][fF]")
+        filenames.update(glob.glob(pattern))
+    return sorted(filenames)
+
+
+def convert_batch(inputs, output_dir, jobs=1, force=False, chunksize=65536,
+                  variables=None, start=None, end=None, format="csv"):
+    """ Convert all CDF files matched by the `inputs` directories or glob
+        patterns into the `output_dir` using a pool of `jobs` worker
+        processes. Outputs newer than their inputs are skipped unless `force`
+        is set. A failed file does not stop the batch. Inputs which would be
+        written to the same output file are rejected before converting.
+
+        Returns the number of failed files.
+    """
+    outputs = {}
+    for input_filename in find_inputs(inputs):
+        output_filename = join(
+            output_dir,
+            splitext(basename(input_filename))[0] + EXTENSIONS[format]
+        )
+        outputs.setdefault(output_filename, []).append(input_filename)
+    collisions = sorted(
+        names for names in outputs.itervalues() if len(names) > 1
+    )
+    if collisions:
+        raise ValueError("Inputs with the same output name: %s" % "; ".join(
+            ", ".join(names) for names in collisions
+        ))
+    if not isdir(output_dir):
+        os.makedirs(output_dir)
+
+    tasks = []
+    skipped = 0
+    for output_filename, (input_filename,) in sorted(
+            outputs.iteritems(), key=lambda item: item[1]):
+        if (not force and exists(output_filename) and
+                getmtime(output_filename) >= getmtime(input_filename)):
+            skipped += 1
+            continue
+        tasks.append((
+            input_filename, output_filename,
+            chunksize, variables, start, end, format
+        ))
+
+    batch_start = time.time()
+    failed = 0
+    if jobs > 1 and len(tasks) > 1:
+        pool = Pool(jobs)
+        results = pool.imap_unordered(_convert_task, tasks)
+    else:
+        pool = None
+        results = imap(_convert_task, tasks)
+
+    try:
+        for input_filename, elapsed, error in results:
+            if error:
+                failed += 1
+                sys.stderr.write(
+                    "FAILED %s (%.3fs): %s\n" % (input_filename, elapsed, error)
+                )
+            else:
+                sys.stderr.write("%s (%.3fs)\n" % (input_filename, elapsed))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    sys.stderr.write(
+        "converted: %d, skipped: %d, failed: %d, elapsed: %.3fs\n" % (
+            len(tasks) - failed, skipped, failed, time.time() - batch_start
+        )
+    )
+    return failed
+
+
+def _convert_task(task):
+    """ Convert one file of the batch and report its timing or error. """
+    input_filename, output_filename = task[:2]
+    task_start = time.time()
+    try:
+        convert_chunked(*task)
+    except Exception:
+        # do not leave partial outputs which would be taken as up-to-date
+        if exists(output_filename):
+            os.remove(output_filename)
+        error = traceback.format_exc().strip().splitlines()[-1]
+        return input_filename, time.time() - task_start, error
+    return input_filename, time.time() - task_start, None
+
+
+def parse_datetime(value):
+    """ Parse an ISO 8601 date or date-time string, e.g.,
+        2016-01-01, 2016-01-01T12:00:00 or 2016-01-01T12:00:00.5Z
+    """
+    value = value.rstrip("Z")
+    for template in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+                     "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, template)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date-time: %s" % value)
+
+
 if __name__ == "__main__":
-    convert(sys.argv[1], sys.argv[2])
+    parser = ArgumentParser()
+    parser.add_argument("--chunksize", "-c", type=int, default=65536,
+        help="Number of records formatted at once. 0 selects the record by "
+             "record writer."
+    )
+    parser.add_argument("--format", "-f", choices=FORMATS, default=None,
+        help="Output format. Guessed from the output extension by default."
+    )
+    parser.add_argument("--variables", "-v", default=None,
+        help="Comma separated list of the exported CDF variables."
+    )
+    parser.add_argument("--start", type=parse_datetime, default=None,
+        help="Export records from this time (inclusive)."
+    )
+    parser.add_argument("--end", type=parse_datetime, default=None,
+        help="Export records until this time (exclusive)."
+    )
+    parser.add_argument("--batch", "-b", action="store_true",
+        help="Convert all CDF files matched by the input directories or glob "
+             "patterns into the output directory."
+    )
+    parser.add_argument("--dir", "-d", default=".",
+        help="Output directory of the batch mode."
+    )
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+        help="Number of worker processes of the batch mode."
+    )
+    parser.add_argument("--force", action="store_true",
+        help="Convert also the files with up-to-date outputs."
+    )
+    parser.add_argument("paths", nargs="+",
+        help="<input> <output>, or the inputs of the batch mode"
+    )
+    parsed = parser.parse_args()
+
+    variables = parsed.variables.split(",") if parsed.variables else None
+
+    if parsed.batch:
+        try:
+            failed = convert_batch(
+                parsed.paths, parsed.dir, parsed.jobs, parsed.force,
+                parsed.chunksize, variables, parsed.start, parsed.end,
+                parsed.format or "csv"
+            )
+        except ValueError as error:
+            parser.error(str(error))
+        sys.exit(1 if failed else 0)
+
+    if len(parsed.paths) != 2:
+        parser.error("expected exactly one input and one output")
+    input_filename, output_filename = parsed.paths
+
+    format_ = parsed.format or {
+        "npz": "npz", "parquet": "parquet"
+    }.get(output_filename.rpartition(".")[2].lower(), "csv")
+
+    convert_chunked(
+        input_filename, output_filename, parsed.chunksize,
+        variables, parsed.start, parsed.end, format_
+    )
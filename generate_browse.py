@@ -1,26 +1,37 @@
 import sys
 import os
-from argparse import ArgumentParser
+import re
+import json
+import hashlib
+from argparse import ArgumentParser, ArgumentTypeError
+from datetime import datetime, timedelta
 from itertools import izip
-from itertools import tee, izip
-from os.path import join, basename
+from itertools import tee, izip, imap
+from os.path import join, basename, exists
+from multiprocessing import Pool
+from threading import Thread
+from Queue import Queue
 
 import numpy as np
 from spacepy import pycdf
-from matplotlib import pyplot as plt
 from osgeo import gdal
 
+import profiling
+
 
 gdal.UseExceptions()
 gdal.AllRegister()
 
 
-report_template = """\
+report_header_template = """\
 <?xml version='1.0' encoding='UTF-8'?>
 <rep:browseReport xmlns:rep="http://ngeo.eo.esa.int/schema/browseReport" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://ngeo.eo.esa.int/schema/browseReport http://ngeo.eo.esa.int/schema/browseReport/browseReport.xsd" version="2.0">
   <rep:responsibleOrgName>EOX</rep:responsibleOrgName>
   <rep:dateTime>2014-01-24T14:53:33Z</rep:dateTime>
   <rep:browseType>%(browse_type)s</rep:browseType>
+"""
+
+browse_template = """\
   <rep:browse>
     <rep:browseIdentifier/>
     <rep:fileName>%(browse_filename)s</rep:fileName>
@@ -31,16 +42,67 @@ report_template = """\
       <rep:coordList>%(coord_list)s</rep:coordList>
       <rep:lookAngle>0.0</rep:lookAngle>
       <rep:verticalCurtainReferenceGrid>
-        <rep:levelsNumber>104</rep:levelsNumber>
-        <rep:heightLevelsList>239.232 479.056 718.893 958.726 1198.527 1438.38 1678.198 1918.025 2157.863 2397.685 2637.507 2877.35 3117.17 3357.011 3596.836 3836.667 4076.491 4316.328 4556.144 4795.979 5035.815 5275.637 5515.458 5755.296 5995.117 6234.956 6474.783 6714.608 6954.445 7194.282 7434.098 7673.934 7913.766 8153.581 8393.422 8633.252 8873.07 9112.904 9352.737 9592.547 9832.395 10072.215 10312.042 10551.875 10791.702 11031.519 11271.369 11511.196 11751.025 11990.863 12230.685 12470.507 12710.341 12950.161 13189.998 13429.829 13669.651 13909.474 14149.311 14389.13 14628.969 14868.805 15108.636 15348.458 15588.296 15828.117 16067.956 16307.781 16547.602 16787.434 17027.271 17267.081 17506.915 17746.753 17986.572 18226.408 18466.243 18706.068 18945.904 19185.737 19425.547 19665.395 19905.215 20145.042 20384.875 20624.702 20864.516 21104.358 21344.178 21584.012 21823.836 22063.667 22303.491 22543.328 22783.152 23022.989 23262.828 23502.651 23742.474 23982.311 24222.13 24461.967 24701.793 24941.618</rep:heightLevelsList>
+%(reference_grid)s
       </rep:verticalCurtainReferenceGrid>
     </rep:verticalCurtainFootprint>
     <rep:startTime>%(start_time)s</rep:startTime>
     <rep:endTime>%(end_time)s</rep:endTime>
   </rep:browse>
+"""
+
+report_footer = """\
 </rep:browseReport>
 """
 
+# height of the top level of the curtain reference grid
+MAX_HEIGHT = 24941.618
+
+EPOCH_1970 = datetime(1970, 1, 1)
+
+# height levels of the default 104 row curtain reference grid, kept verbatim
+# as they are not exactly equally spaced
+DEFAULT_HEIGHT_LEVELS = (
+    "239.232 479.056 718.893 958.726 1198.527 1438.38 1678.198 1918.025 "
+    "2157.863 2397.685 2637.507 2877.35 3117.17 3357.011 3596.836 3836.667 "
+    "4076.491 4316.328 4556.144 4795.979 5035.815 5275.637 5515.458 5755.296 "
+    "5995.117 6234.956 6474.783 6714.608 6954.445 7194.282 7434.098 7673.934 "
+    "7913.766 8153.581 8393.422 8633.252 8873.07 9112.904 9352.737 9592.547 "
+    "9832.395 10072.215 10312.042 10551.875 10791.702 11031.519 11271.369 "
+    "11511.196 11751.025 11990.863 12230.685 12470.507 12710.341 12950.161 "
+    "13189.998 13429.829 13669.651 13909.474 14149.311 14389.13 14628.969 "
+    "14868.805 15108.636 15348.458 15588.296 15828.117 16067.956 16307.781 "
+    "16547.602 16787.434 17027.271 17267.081 17506.915 17746.753 17986.572 "
+    "18226.408 18466.243 18706.068 18945.904 19185.737 19425.547 19665.395 "
+    "19905.215 20145.042 20384.875 20624.702 20864.516 21104.358 21344.178 "
+    "21584.012 21823.836 22063.667 22303.491 22543.328 22783.152 23022.989 "
+    "23262.828 23502.651 23742.474 23982.311 24222.13 24461.967 24701.793 "
+    "24941.618"
+)
+
+
+def parse_interval(value):
+    """ Parse a time interval such as 10min, 1h, 30s or 500ms to seconds. """
+    match = re.match(r"^\s*(\d+(?:\.\d*)?)\s*(ms|s|min|h|d)?\s*$", value)
+    if not match:
+        raise ArgumentTypeError("Invalid time interval: %s" % value)
+    number, unit = match.groups()
+    return float(number) * {
+        "ms": 0.001, "s": 1, None: 1, "min": 60, "h": 3600, "d": 86400,
+    }[unit]
+
+
+def parse_datetime(value):
+    """ Parse an ISO 8601 date or date-time string. """
+    value = value.rstrip("Z")
+    for template in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+                     "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, template)
+        except ValueError:
+            pass
+    raise ArgumentTypeError("Invalid date-time: %s" % value)
+
+
 def pairwise(iterable):
     "s -> (s0,s1), (s1,s2), (s2, s3), ..."
     a, b = tee(iterable)
@@ -48,96 +110,593 @@ def pairwise(iterable):
     return izip(a, b)
 
 
-def savefig_pix(fig, fname, width, height, dpi=100):
-    rdpi = 1.0/float(dpi)
-    fig.set_size_inches(width*rdpi, height*rdpi)
-    fig.savefig(fname, dpi=dpi)
-
-def to_array(fig, width, height, dpi=100):
-    rdpi = 1.0/float(dpi)
-    fig.set_size_inches(width*rdpi, height*rdpi)
-    fig.canvas.draw()
-    data = np.fromstring(fig.canvas.tostring_rgb(), dtype=np.uint8, sep='')
-    return data.reshape(fig.canvas.get_width_height()[::-1] + (3,))
-
-
-def generate(input_filename, output_template, 
-             start=0, stop=None, step=1000, x_size=1000, y_size=104):
-    cdf = pycdf.CDF(input_filename)
-    stop = stop or len(cdf["Timestamp"])
-
-    browse_type = "_".join(basename(input_filename).split("_")[:5])
-
-    r = range(start, stop, step)
-    for i, (chunk_start, chunk_end) in enumerate(pairwise(r)):
-        time = cdf["Timestamp"][chunk_start:chunk_end]
-        lons = cdf["Longitude"][chunk_start:chunk_end]
-        lats = cdf["Latitude"][chunk_start:chunk_end]
-        rad = cdf["Radius"][chunk_start:chunk_end]
-        f = cdf["F"][chunk_start:chunk_end]
-
-
-        browse_filename = output_template % i
-        report_filename = browse_filename.rpartition(".")[0] + ".xml"
-        tmp_filename = browse_filename.rpartition(".")[0] + "_tmp_." + browse_filename.rpartition(".")[-1]
-        
-        fig = plt.figure()
-        ax = fig.add_subplot(111, axisbg="black")
-
-        x = np.arange(0, len(time))
-        ax.fill_between(x, 0, f, facecolor="white")
-        ax.plot(x, f, color="white")
-
-        ax.set_xlim([0, len(time)])
-
-        fig.subplots_adjust(wspace=0, hspace=0, left=0, right=1, bottom=0, top=1)
-        savefig_pix(fig, tmp_filename, x_size, y_size)
-        plt.close()
-
-        # save TIFF via GDAL
-        tmp_ds = gdal.Open(tmp_filename)
-        tmp_band = tmp_ds.GetRasterBand(1)
+def round_limit(value, nbins=9):
+    """ Round the value up to a "nice" axis limit the way the matplotlib
+        auto-scaling does it.
+    """
+    if value <= 0:
+        return 0.0
+    raw_step = value / float(nbins)
+    scale = 10 ** np.floor(np.log10(raw_step))
+    for step in (1, 2, 2.5, 5, 10):
+        if step * scale >= raw_step:
+            break
+    step *= scale
+    return np.ceil(value / step) * step
+
+
+def to_array(values, width, height, vmin=None, vmax=None):
+    """ Render the area between zero and the values as a white on black
+        image. Each pixel column covers its share of the samples and is
+        filled between the column minimum and maximum so that no spike is
+        lost. Returns an uint8 array of shape (height, width).
+    """
+    with profiling.stage("render"):
+        values = np.asarray(values, dtype="float64")
+        edges = (np.arange(width) * len(values)) // width
+        low = np.minimum(np.minimum.reduceat(values, edges), 0)
+        high = np.maximum(np.maximum.reduceat(values, edges), 0)
+
+        if vmin is None:
+            vmin = -round_limit(-low.min())
+        if vmax is None:
+            vmax = round_limit(high.max())
+        scale = height / float(vmax - vmin or 1)
+
+        # pixel centres measured from the bottom of the image
+        centres = (np.arange(height, 0, -1) - 0.5)[:, np.newaxis]
+        return np.where(
+            (centres >= (low - vmin) * scale) &
+            (centres <= (high - vmin) * scale),
+            255, 0
+        ).astype("uint8")
+
+
+def write_tiff(filename, data):
+    """ Write a single band uint8 array as a GeoTIFF. """
+    with profiling.stage("gdal_write"):
         driver = gdal.GetDriverByName("GTiff")
-        ds = driver.Create(browse_filename, x_size, y_size, 1, gdal.GDT_Byte)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(tmp_band.ReadAsArray())
-        del band, ds, tmp_band, tmp_ds
-
-        os.remove(tmp_filename)
+        ds = driver.Create(
+            filename, data.shape[1], data.shape[0], 1, gdal.GDT_Byte
+        )
+        ds.GetRasterBand(1).WriteArray(data)
+        del ds
+
+
+def write_cog(filename, values, width, height, overviews):
+    """ Write the rendered values as an internally tiled, Cloud-Optimized
+        GeoTIFF with `overviews` levels of overviews. Each overview is
+        rendered from the samples, not resampled from the full image, so the
+        min/max envelope keeps the spikes visible at every level.
+    """
+    mem_ds = gdal.GetDriverByName("MEM").Create(
+        "", width, height, 1, gdal.GDT_Byte
+    )
+    band = mem_ds.GetRasterBand(1)
+    band.WriteArray(to_array(values, width, height))
+    mem_ds.BuildOverviews(
+        "NEAREST", [2 ** level for level in xrange(1, overviews + 1)]
+    )
+    for level in xrange(band.GetOverviewCount()):
+        overview = band.GetOverview(level)
+        overview.WriteArray(
+            to_array(values, overview.XSize, overview.YSize)
+        )
+    del band
 
-        # create a report
+    with profiling.stage("gdal_write"):
+        driver = gdal.GetDriverByName("GTiff")
+        ds = driver.CreateCopy(filename, mem_ds, options=[
+            "TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256",
+            "COPY_SRC_OVERVIEWS=YES", "COMPRESS=DEFLATE",
+        ])
+        del ds, mem_ds
+
+
+def write_pyramid(filename, values, width, height, levels):
+    """ Write the full resolution image and `levels` separate images, each
+        decimated by another factor of two, named <name>_l<level>.<ext>.
+    """
+    write_tiff(filename, to_array(values, width, height))
+    for level, level_filename in enumerate(
+            pyramid_filenames(filename, levels), 1):
+        factor = 2 ** level
+        write_tiff(
+            level_filename,
+            to_array(
+                values,
+                max(1, (width + factor - 1) // factor),
+                max(1, (height + factor - 1) // factor),
+            )
+        )
 
-        out_step = step / 100
 
-        # generate coord list
-        
-        col_row_list = " ".join(
-            "%d 0" % i for i in xrange(0, step, out_step)
+def pyramid_filenames(filename, levels):
+    """ Get the filenames of the decimated levels of a pyramid. """
+    base, _, extension = filename.rpartition(".")
+    return [
+        "%s_l%d.%s" % (base, level, extension)
+        for level in xrange(1, levels + 1)
+    ]
+
+
+_reference_grids = {}
+
+
+def reference_grid(height, max_height=MAX_HEIGHT):
+    """ Get the formatted vertical curtain reference grid with one height
+        level per image row. The default 104 rows up to `MAX_HEIGHT` give the
+        historical levels, other grids are equally spaced up to `max_height`
+        with the first level placed like in the historical grid. The result
+        is cached as it is the same for all chunks.
+    """
+    key = (height, max_height)
+    if key not in _reference_grids:
+        if height == 104 and max_height == MAX_HEIGHT:
+            levels = DEFAULT_HEIGHT_LEVELS
+        else:
+            default_levels = DEFAULT_HEIGHT_LEVELS.split()
+            # the first level relative to the mean row height
+            first = float(default_levels[0]) * len(default_levels) / MAX_HEIGHT
+            levels = " ".join(
+                ("%.3f" % level).rstrip("0").rstrip(".")
+                for level in np.linspace(
+                    first * max_height / float(height), max_height, height
+                )
+            )
+        _reference_grids[key] = (
+            "        <rep:levelsNumber>%d</rep:levelsNumber>\n"
+            "        <rep:heightLevelsList>%s</rep:heightLevelsList>" % (
+                height, levels
+            )
         )
-        col_row_list += " %d 0" % (step - 1)
-
-        coord_list = " ".join(
-            "%f %f" % (lat, lon)
-            for lat, lon in izip(lats[::out_step], lons[::out_step])
+    return _reference_grids[key]
+
+
+def browse_report(browse_filename, start_time, end_time, lons, lats,
+                  x_size=1000, y_size=104, max_height=MAX_HEIGHT):
+    """ Get the rep:browse element of a single chunk. The footprint consists
+        of every hundredth sample plus the exact end.
+    """
+    step = len(lons)
+    out_step = max(1, step / 100)
+
+    samples = np.arange(0, step, out_step)
+    # map the sample indices to the image columns
+    cols = (samples * ((x_size - 1) / float(max(1, step - 1)))).astype("int")
+    cols = np.append(cols, x_size - 1)
+    samples = np.append(samples, step - 1)
+    node_number = len(samples)
+
+    col_row = np.zeros((node_number, 2), dtype="int")
+    col_row[:, 0] = cols
+    coords = np.empty((node_number, 2))
+    coords[:, 0] = lats[samples]
+    coords[:, 1] = lons[samples]
+
+    return browse_template % {
+        "node_number": node_number,
+        "browse_filename": browse_filename,
+        "col_row_list": " ".join(["%d %d"] * node_number) % tuple(
+            col_row.ravel().tolist()
+        ),
+        "coord_list": " ".join(["%f %f"] * node_number) % tuple(
+            coords.ravel().tolist()
+        ),
+        "reference_grid": reference_grid(y_size, max_height),
+        "start_time": start_time.isoformat("T"),
+        "end_time": end_time.isoformat("T"),
+    }
+
+
+def write_report(filename, browse_type, browses):
+    """ Write a browse report with one or more rep:browse elements. """
+    with profiling.stage("report_write"), open(filename, "w") as f:
+        f.write(report_header_template % {"browse_type": browse_type})
+        for browse in browses:
+            f.write(browse)
+        f.write(report_footer)
+
+
+class ChunkReader(object):
+    """ Reader of the CDF variables needed by the browse renderer.
+
+    The variables are read in large contiguous slabs, optionally with
+    a read-ahead of the next slab on a background thread, and the chunks are
+    handed out as views of the slabs. Only the boundary timestamps of the
+    chunks are converted to datetime objects.
+    """
+
+    def __init__(self, cdf, variables=("Longitude", "Latitude", "F"),
+                 time_variable="Timestamp", slab_size=100000, prefetch=False):
+        self.cdf = cdf
+        self.variables = variables
+        self.time_variable = time_variable
+        self.time_type = cdf[time_variable].type()
+        self.slab_size = slab_size
+        self.prefetch = prefetch
+        self._index = None
+
+    def __len__(self):
+        return len(self.cdf[self.time_variable])
+
+    def read(self, start, stop):
+        """ Read one slab. The time variable is read as raw CDF values. """
+        with profiling.stage("cdf_read"):
+            slab = {
+                self.time_variable:
+                    self.cdf.raw_var(self.time_variable)[start:stop]
+            }
+            for variable in self.variables:
+                slab[variable] = self.cdf[variable][start:stop]
+            return slab
+
+    def index(self):
+        """ Get the raw values of the whole time variable. The values are read
+            once and used to locate chunk boundaries by a binary search.
+        """
+        if self._index is None:
+            if self.time_type == pycdf.const.CDF_EPOCH16.value:
+                raise ValueError("CDF_EPOCH16 time variables are not indexed")
+            self._index = np.asarray(
+                self.cdf.raw_var(self.time_variable)[...]
+            )
+        return self._index
+
+    def raw_per_second(self):
+        """ Get the number of raw time units per second. """
+        if self.time_type == pycdf.const.CDF_TIME_TT2000.value:
+            return 1e9
+        return 1e3
+
+    def from_datetime(self, value):
+        """ Convert a datetime object to a raw CDF time value. """
+        if self.time_type == pycdf.const.CDF_EPOCH.value:
+            return pycdf.lib.datetime_to_epoch(value)
+        elif self.time_type == pycdf.const.CDF_TIME_TT2000.value:
+            return pycdf.lib.datetime_to_tt2000(value)
+        raise ValueError("%s is not an indexed time variable" %
+                         self.time_variable)
+
+    def time_bounds(self, interval, time_from=None, time_to=None,
+                    max_gap=None):
+        """ Get `(label, start, stop)` record bounds of chunks covering
+            `interval` seconds each. The chunk edges are aligned to multiples
+            of the interval since 1970-01-01 unless `time_from` is given.
+            An explicit `time_to` is exclusive, otherwise the chunks cover
+            the last record. Chunks are further split at gaps longer than
+            `max_gap` seconds. The labels of sub-second intervals include
+            the microseconds so that they stay unique.
+        """
+        index = self.index()
+        if not len(index):
+            return []
+
+        if time_from is None:
+            first = self.to_datetime(index[0])
+            offset = (first - EPOCH_1970).total_seconds()
+            time_from = EPOCH_1970 + timedelta(
+                seconds=np.floor(offset / interval) * interval
+            )
+        edges = []
+        edge = time_from
+        step = timedelta(seconds=interval)
+        if time_to is None:
+            # the chunks cover the last record
+            last = self.to_datetime(index[-1])
+            while edge <= last:
+                edges.append(edge)
+                edge += step
+            edges.append(edge)
+        else:
+            # an explicit end is exclusive
+            while edge < time_to:
+                edges.append(edge)
+                edge += step
+            edges.append(min(edge, time_to))
+
+        records = np.searchsorted(
+            index, [self.from_datetime(edge) for edge in edges], "left"
         )
-        coord_list += " %f %f" % (lats[-1], lons[-1]) # finish with exact end
 
+        max_gap_raw = max_gap * self.raw_per_second() if max_gap else None
+        label_format = "%Y%m%dT%H%M%S.%f" if interval % 1 else "%Y%m%dT%H%M%S"
+        bounds = []
+        for edge, (start, stop) in izip(edges, pairwise(records)):
+            label = edge.strftime(label_format)
+            parts = [start, stop]
+            if max_gap_raw is not None and stop - start > 1:
+                gaps = np.flatnonzero(np.diff(index[start:stop]) > max_gap_raw)
+                parts[1:1] = (gaps + start + 1).tolist()
+            for part, (part_start, part_stop) in enumerate(pairwise(parts)):
+                # a curtain needs at least two records
+                if part_stop - part_start < 2:
+                    continue
+                part_label = label if part == 0 else "%s_%d" % (label, part)
+                bounds.append((part_label, part_start, part_stop))
+        return bounds
+
+    def to_datetime(self, value):
+        """ Convert a raw CDF time value to a datetime object. """
+        if self.time_type == pycdf.const.CDF_EPOCH.value:
+            return pycdf.lib.epoch_to_datetime(value)
+        elif self.time_type == pycdf.const.CDF_TIME_TT2000.value:
+            return pycdf.lib.tt2000_to_datetime(value)
+        elif self.time_type == pycdf.const.CDF_EPOCH16.value:
+            return pycdf.lib.epoch16_to_datetime(value[0], value[1])
+        raise ValueError("%s is not a time variable" % self.time_variable)
+
+    def slabs(self, bounds):
+        """ Group the sorted `(start, stop)` chunk bounds into slabs of at
+            most `slab_size` records (or a single larger chunk) and yield
+            `(slab_start, slab, chunk_bounds)` tuples.
+        """
+        def _groups():
+            group = []
+            for chunk_start, chunk_end in bounds:
+                if group and chunk_end - group[0][0] > self.slab_size:
+                    yield group
+                    group = []
+                group.append((chunk_start, chunk_end))
+            if group:
+                yield group
+
+        def _read(group):
+            slab_start, slab_end = group[0][0], group[-1][1]
+            return slab_start, self.read(slab_start, slab_end), group
+
+        if not self.prefetch:
+            for group in _groups():
+                yield _read(group)
+            return
+
+        # read-ahead of one slab on a background thread
+        queue = Queue(maxsize=1)
+
+        def _producer():
+            try:
+                for group in _groups():
+                    queue.put((_read(group), None))
+            except Exception as error:
+                queue.put((None, error))
+            queue.put((None, None))
+
+        thread = Thread(target=_producer)
+        thread.daemon = True
+        thread.start()
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is None:
+                break
+            yield item
+        thread.join()
+
+    def chunks(self, bounds):
+        """ Yield `(start_time, end_time, lons, lats, f)` tuples of the
+            chunks with the given `(start, stop)` record bounds.
+        """
+        lon_var, lat_var, f_var = self.variables
+        for slab_start, slab, group in self.slabs(bounds):
+            times = slab[self.time_variable]
+            for chunk_start, chunk_end in group:
+                first = chunk_start - slab_start
+                last = chunk_end - slab_start
+                yield (
+                    self.to_datetime(times[first]),
+                    self.to_datetime(times[last - 1]),
+                    slab[lon_var][first:last],
+                    slab[lat_var][first:last],
+                    slab[f_var][first:last],
+                )
+
+
+class Manifest(object):
+    """ Record of the rendered browse chunks stored next to the outputs.
+
+    The manifest is a JSON-lines file with one entry per completed chunk
+    holding the input file identity, the chunk boundaries, the render
+    parameters and a content hash of the source slice. An entry is appended
+    as soon as its chunk is written so that an interrupted run can resume.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        if exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # truncated by an interrupted run
+                    self.entries[entry["label"]] = entry
+            # compact the manifest to the latest entry of each chunk
+            tmp_filename = filename + ".tmp"
+            with open(tmp_filename, "w") as f:
+                for entry in self.entries.itervalues():
+                    f.write(json.dumps(entry, sort_keys=True) + "\n")
+            os.rename(tmp_filename, filename)
+        self._file = open(filename, "a")
+
+    def is_current(self, entry, filenames):
+        """ Check whether the chunk described by the entry is recorded with
+            the same boundaries, parameters and content and whether all its
+            output files exist.
+        """
+        recorded = self.entries.get(entry["label"])
+        if recorded is None:
+            return False
+        for key in ("start", "stop", "params", "hash"):
+            if recorded.get(key) != entry[key]:
+                return False
+        return all(exists(filename) for filename in filenames)
+
+    def add(self, entry):
+        self.entries[entry["label"]] = entry
+        self._file.write(json.dumps(entry, sort_keys=True) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def chunk_hash(start_time, end_time, lons, lats, f):
+    """ Get the content hash of a chunk's source slice. """
+    digest = hashlib.sha1()
+    digest.update(start_time.isoformat("T").encode("ascii"))
+    digest.update(end_time.isoformat("T").encode("ascii"))
+    for array in (lons, lats, f):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def file_identity(filename):
+    """ Get the identity of the input file recorded in the manifest. """
+    stat = os.stat(filename)
+    return {
+        "name": basename(filename), "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+class ChunkError(Exception):
+    """ Error raised when a browse chunk cannot be rendered. """
 
-        node_number = len(coord_list.split(" ")) / 2
 
+def generate(input_filename, output_template, 
+             start=0, stop=None, step=1000, x_size=1000, y_size=104, jobs=1,
+             slab_size=100000, prefetch=False,
+             interval=None, time_from=None, time_to=None, max_gap=None,
+             manifest_filename=None, overviews=0, pyramid=False,
+             combined_report_filename=None, max_height=MAX_HEIGHT):
+    if pyramid and not overviews:
+        raise ValueError("A pyramid requires at least one overview level")
 
-        report = report_template % {
-            "browse_type": browse_type,
-            "node_number": node_number,
-            "browse_filename": browse_filename,
-            "col_row_list": col_row_list,
-            "coord_list": coord_list,
-            "start_time": time[0].isoformat("T"),
-            "end_time": time[-1].isoformat("T"),
-        }
+    cdf = pycdf.CDF(input_filename)
+    reader = ChunkReader(cdf, slab_size=slab_size, prefetch=prefetch)
+    stop = stop or len(reader)
 
-        with open(report_filename, "w") as f:
-            f.write(report)
+    browse_type = "_".join(basename(input_filename).split("_")[:5])
+
+    if interval:
+        labeled_bounds = reader.time_bounds(
+            interval, time_from, time_to, max_gap
+        )
+        labels = [label for label, _, _ in labeled_bounds]
+        bounds = [(start, stop) for _, start, stop in labeled_bounds]
+    else:
+        bounds = list(pairwise(range(start, stop, step)))
+        labels = range(len(bounds))
+
+    manifest = Manifest(manifest_filename) if manifest_filename else None
+    identity = file_identity(input_filename)
+    combined = combined_report_filename is not None
+    params = {
+        "width": x_size, "height": y_size, "step": step,
+        "overviews": overviews, "pyramid": pyramid,
+        "max_height": max_height,
+        "report": "combined" if combined else "chunk",
+    }
+    pending = {}
+    # rep:browse elements of the combined report
+    browses = []
+
+    def tasks():
+        chunks = reader.chunks(bounds)
+        for i, (label, (chunk_start, chunk_stop), chunk) in enumerate(
+                izip(labels, bounds, chunks)):
+            browse_filename = output_template % label
+            outputs = [browse_filename]
+            if pyramid:
+                outputs.extend(pyramid_filenames(browse_filename, overviews))
+            if combined:
+                start_time, end_time, lons, lats, _ = chunk
+                with profiling.stage("report"):
+                    browses.append(browse_report(
+                        browse_filename, start_time, end_time, lons, lats,
+                        x_size, y_size, max_height
+                    ))
+            else:
+                outputs.append(browse_filename.rpartition(".")[0] + ".xml")
+            if manifest is not None:
+                entry = {
+                    "label": str(label), "input": identity,
+                    "start": int(chunk_start), "stop": int(chunk_stop),
+                    "params": params, "hash": chunk_hash(*chunk),
+                }
+                if manifest.is_current(entry, outputs):
+                    continue
+                pending[i] = entry
+            yield (i, browse_filename, browse_type) + chunk + (
+                x_size, y_size, overviews, pyramid, not combined, max_height
+            )
+
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = profiling.merged(
+            pool.imap(profiling.worker(_render_chunk), tasks())
+        )
+    else:
+        pool = None
+        results = imap(_render_chunk, tasks())
+
+    try:
+        for index in results:
+            if manifest is not None:
+                manifest.add(pending.pop(index))
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
+        if manifest is not None:
+            manifest.close()
+
+    if combined:
+        write_report(combined_report_filename, browse_type, browses)
+
+
+def _render_chunk(task):
+    """ Render one chunk, errors are reported with the index of the chunk. """
+    try:
+        with profiling.stage("render_chunk"):
+            render_chunk(*task)
+    except Exception as error:
+        raise ChunkError("Chunk %d failed: %s: %s" % (
+            task[0], type(error).__name__, error
+        ))
+    return task[0]
+
+
+def render_chunk(index, browse_filename, browse_type, start_time, end_time,
+                 lons, lats, f, x_size=1000, y_size=104, overviews=0,
+                 pyramid=False, report=True, max_height=MAX_HEIGHT):
+    """ Write the browse image and, unless disabled, the browse report of
+        a single chunk.
+    """
+    report_filename = browse_filename.rpartition(".")[0] + ".xml"
+
+    if not overviews:
+        write_tiff(browse_filename, to_array(f, x_size, y_size))
+    elif pyramid:
+        write_pyramid(browse_filename, f, x_size, y_size, overviews)
+    else:
+        write_cog(browse_filename, f, x_size, y_size, overviews)
+
+    if report:
+        with profiling.stage("report"):
+            browse = browse_report(
+                browse_filename, start_time, end_time, lons, lats,
+                x_size, y_size, max_height
+            )
+        write_report(report_filename, browse_type, [browse])
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -147,12 +706,58 @@ if __name__ == "__main__":
     parser.add_argument("--chunksize", "-c", type=int, default=1000, help="Chunksize")
     parser.add_argument("--width", type=int, default=1000)
     parser.add_argument("--height", type=int, default=104)
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of worker processes")
+    parser.add_argument("--slab-size", type=int, default=100000,
+                        help="Number of records read from the CDF at once")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Read the next slab on a background thread")
+    parser.add_argument("--interval", "-i", type=parse_interval, default=None,
+                        help="Cut chunks by time, e.g., 10min, instead of "
+                             "by record count")
+    parser.add_argument("--from", dest="time_from", type=parse_datetime,
+                        default=None, help="Start time of the time chunks")
+    parser.add_argument("--to", dest="time_to", type=parse_datetime,
+                        default=None, help="End time of the time chunks")
+    parser.add_argument("--max-gap", type=parse_interval, default=None,
+                        help="Split the time chunks at longer data gaps")
+    parser.add_argument("--overviews", type=int, default=0,
+                        help="Write tiled Cloud-Optimized GeoTIFFs with this "
+                             "number of overview levels")
+    parser.add_argument("--pyramid", action="store_true",
+                        help="Write the overview levels as separate images")
+    parser.add_argument("--max-height", type=float, default=MAX_HEIGHT,
+                        help="Height of the top level of the curtain grid")
+    parser.add_argument("--combined-report", action="store_true",
+                        help="Write one browse report per input file instead "
+                             "of one per chunk")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Render only the chunks which are missing or "
+                             "changed since the last run")
+    profiling.add_arguments(parser)
 
     parser.add_argument("filename", nargs=1)
     parsed = parser.parse_args()
+    if parsed.pyramid and not parsed.overviews:
+        parser.error("--pyramid requires --overviews")
+    profiling.configure(parsed.metrics_file, parsed.profile)
+    combined_report_filename = None
+    if parsed.combined_report:
+        combined_report_filename = join(
+            parsed.dir, basename(parsed.filename[0]) + ".xml"
+        )
+    manifest_filename = None
+    if parsed.incremental:
+        manifest_filename = join(
+            parsed.dir, basename(parsed.filename[0]) + ".manifest"
+        )
     generate(
-        parsed.filename[0], join(parsed.dir, basename(parsed.filename[0] + "_%d.tif")), 
+        parsed.filename[0], join(parsed.dir, basename(parsed.filename[0] + "_%s.tif")), 
         parsed.offset, parsed.stop, parsed.chunksize,
-        parsed.width, parsed.height
+        parsed.width, parsed.height, parsed.jobs,
+        parsed.slab_size, parsed.prefetch,
+        parsed.interval, parsed.time_from, parsed.time_to, parsed.max_gap,
+        manifest_filename, parsed.overviews, parsed.pyramid,
+        combined_report_filename, parsed.max_height
     )
-
+    profiling.finish(script="generate_browse", input=parsed.filename[0])
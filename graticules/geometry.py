@@ -0,0 +1,105 @@
+"""Longitude and Antimeridian helpers shared by the warp and tile writers."""
+
+# ------------------------------------------------------------------------------
+# Copyright (C) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies of this Software or works derived from this Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# ------------------------------------------------------------------------------
+
+import numpy as np
+from shapely.geometry import box, MultiLineString, MultiPolygon
+from shapely.affinity import translate
+from shapely.ops import unary_union
+
+
+WGS84_BOUNDS = box(-180, -90, 180, 90)
+WGS84_LEFT = box(-540, -90, -180, 90)
+WGS84_RIGHT = box(180, -90, 540, 90)
+
+
+def wrap(lon):
+    """Wrap longitudes or longitude differences to [-180, 180)."""
+    return np.mod(np.asarray(lon) + 180., 360.) - 180.
+
+
+def singles(geom):
+    """Return the single part geometries of a geometry."""
+    if geom.type.startswith("Multi") or geom.type == "GeometryCollection":
+        return list(geom.geoms)
+    return [geom]
+
+
+def unwrap(coords, reference=None):
+    """
+    Remove the 360 degree jumps of longitudes along a coordinate sequence.
+
+    Longitudes are only shifted by whole multiples of 360 degrees, so equal
+    vertices stay equal unless the sequence goes around a pole. The first
+    longitude is shifted towards the optional reference longitude.
+    """
+    out = np.array(coords, dtype=float)
+    if not len(out):
+        return out
+    turns = np.zeros(len(out))
+    turns[1:] = np.cumsum(np.round(np.diff(out[:, 0]) / 360.))
+    if reference is not None:
+        turns += np.round((out[0, 0] - reference) / 360.)
+    out[:, 0] -= 360. * turns
+    return out
+
+
+def unwrap_ring(coords, reference=None):
+    """
+    Unwrap a polygon ring (see unwrap()) and keep it closed.
+
+    A ring going around a pole ends 360 degrees away from its start and is
+    closed along the pole of the hemisphere holding most of its vertices.
+    """
+    out = unwrap(coords, reference)
+    if len(out) < 2:
+        return out
+    if out[-1, 0] != out[0, 0]:
+        pole = 90. if np.mean(out[:, 1]) >= 0 else -90.
+        out = np.vstack((
+            out, [[out[-1, 0], pole], [out[0, 0], pole], out[0]]))
+    out[-1] = out[0]
+    return out
+
+
+def split_antimeridian(out_geom):
+    """Return geometry while correctly dealing with Antimeridian."""
+    # Lines or polygons crossing the Antimeridian will get clipped and
+    # returned as MultiLineStrings or MultiPolygons.
+    if WGS84_BOUNDS.contains(out_geom):
+        return out_geom
+    part_type = out_geom.type.replace("Multi", "")
+    parts = []
+    for clip_box, xoff in (
+        (WGS84_BOUNDS, 0), (WGS84_LEFT, 360), (WGS84_RIGHT, -360)
+    ):
+        clipped = clip_box.intersection(out_geom)
+        for part in singles(clipped):
+            # kick out empty geometries and degenerate clipping results
+            if part.type == part_type and not part.is_empty:
+                parts.append(translate(part, xoff=xoff))
+    if part_type == "Polygon":
+        # the pieces of a polygon going around a pole share the cut edge
+        return MultiPolygon(singles(unary_union(parts)))
+    return MultiLineString(parts)
+
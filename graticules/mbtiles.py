@@ -0,0 +1,455 @@
+"""Writes vector features as pre-tiled Mapbox vector tiles into MBTiles."""
+
+# ------------------------------------------------------------------------------
+# Copyright (C) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies of this Software or works derived from this Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import zlib
+import numbers
+import sqlite3
+import multiprocessing
+from collections import defaultdict
+import numpy as np
+from shapely import wkb
+from shapely.geometry import (
+    shape, box, MultiPoint, MultiLineString, MultiPolygon)
+from shapely.ops import transform
+
+from geometry import singles, split_antimeridian
+
+
+# Spherical (web) Mercator
+EARTH_RADIUS = 6378137.
+ORIGIN = np.pi * EARTH_RADIUS
+MAX_LATITUDE = 85.0511287798066
+MERCATOR_BOUNDS = box(-180., -MAX_LATITUDE, 180., MAX_LATITUDE)
+
+TILE_SIZE = 256
+EXTENT = 4096
+
+# attributes never written to tiles and label attributes dropped below the
+# label zoom level
+DROPPED_FIELDS = ("scalerank",)
+LABEL_FIELDS = ("display", "direction")
+
+
+class MBTilesWriter(object):
+    """
+    Write vector features as vector tiles into an MBTiles file.
+
+    The features are split at the Antimeridian like the warped features,
+    projected and spooled to a temporary SQLite file as they are written, so
+    that only the features of the tiles being encoded are held in memory.
+    For each zoom level the spooled features are simplified to simplify
+    pixels and indexed by the tiles extended by buffer pixels, and the tiles
+    are clipped and encoded by a pool of jobs worker processes. Tiles are
+    inserted in transactions of batch_size tiles.
+    """
+
+    def __init__(
+        self, filename, minzoom=0, maxzoom=6, jobs=1, buffer=4.,
+        simplify=0.5, label_minzoom=3, batch_size=1000, name=None
+    ):
+        self.filename = filename
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+        self.jobs = jobs
+        self.buffer = buffer
+        self.simplify = simplify
+        self.label_minzoom = label_minzoom
+        self.batch_size = batch_size
+        self.name = name or os.path.splitext(os.path.basename(filename))[0]
+        self.fields = defaultdict(dict)
+        self.spool_filename = "%s.%d.spool" % (filename, os.getpid())
+        self.spool = _create_spool(self.spool_filename)
+        self.pending = []
+
+    def layer(self, name):
+        """Return a fiona-like sink of one vector tile layer."""
+        return _Layer(self, name)
+
+    def write(self, feature, layer=None):
+        """Add a GeoJSON-like feature to the (default) layer."""
+        layer = layer or self.name
+        properties = dict(feature["properties"])
+        for key, value in properties.items():
+            if value is not None and key not in DROPPED_FIELDS:
+                self.fields[layer][key] = _field_type(value)
+        properties = json.dumps(properties)
+        for part in _project(feature["geometry"]):
+            self.pending.append((layer, sqlite3.Binary(part.wkb), properties))
+        if len(self.pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        """Write the pending features to the spool."""
+        with self.spool:
+            self.spool.executemany(
+                "INSERT INTO features (layer, geometry, properties) "
+                "VALUES (?, ?, ?)", self.pending)
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def close(self):
+        """Tile the spooled features and write the MBTiles file."""
+        try:
+            self._flush()
+            if os.path.isfile(self.filename):
+                os.remove(self.filename)
+            connection = sqlite3.connect(self.filename)
+            try:
+                connection.execute("PRAGMA synchronous=OFF")
+                connection.execute("PRAGMA journal_mode=MEMORY")
+                _create_schema(connection)
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO metadata (name, value) VALUES (?, ?)",
+                        self.metadata().items())
+                for zoom in range(self.minzoom, self.maxzoom + 1):
+                    _insert_tiles(
+                        connection, self.tiles(zoom), self.batch_size)
+            finally:
+                connection.close()
+        finally:
+            self.discard()
+
+    def discard(self):
+        """Remove the spooled features, e.g., after an error."""
+        self.spool.close()
+        if os.path.isfile(self.spool_filename):
+            os.remove(self.spool_filename)
+
+    def metadata(self):
+        """Return the MBTiles metadata."""
+        return {
+            "name": self.name,
+            "format": "pbf",
+            "type": "overlay",
+            "minzoom": str(self.minzoom),
+            "maxzoom": str(self.maxzoom),
+            "bounds": "-180,%f,180,%f" % (-MAX_LATITUDE, MAX_LATITUDE),
+            "center": "0,0,%d" % self.minzoom,
+            "json": json.dumps({"vector_layers": [
+                {
+                    "id": layer, "fields": self.fields[layer],
+                    "minzoom": self.minzoom, "maxzoom": self.maxzoom,
+                }
+                for layer in sorted(self.fields)]}),
+        }
+
+    def tiles(self, zoom):
+        """Yield (zoom, column, row, data) of the non-empty tiles of a zoom."""
+        self._index_zoom(zoom)
+        tasks = [
+            (self.spool_filename, self.buffer, zoom, column, row)
+            for column, row in self.spool.execute(
+                "SELECT DISTINCT tile_column, tile_row FROM tile_features "
+                "ORDER BY tile_column, tile_row")]
+
+        if self.jobs > 1 and len(tasks) > 1:
+            # The workers read the tile features from the spool.
+            pool = multiprocessing.Pool(self.jobs)
+            results = pool.imap_unordered(
+                _encode_tile, tasks,
+                chunksize=max(1, len(tasks) // (self.jobs * 16)))
+        else:
+            pool = None
+            results = (_encode_tile(task, self.spool) for task in tasks)
+        try:
+            for tile in results:
+                if tile is not None:
+                    yield tile
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _index_zoom(self, zoom):
+        """Spool the simplified features of a zoom and their tiles."""
+        size = 2 * ORIGIN / 2 ** zoom
+        tolerance = self.simplify * size / TILE_SIZE
+        margin = self.buffer * size / TILE_SIZE
+        spool = self.spool
+        spool.executescript("""
+            DROP INDEX IF EXISTS tile_features_index;
+            DELETE FROM zoom_features;
+            DELETE FROM tile_features;
+        """)
+        features, tiles = [], []
+        # the inserts are committed once the whole zoom is indexed
+        cursor = spool.cursor()
+        for index, layer, data, properties in spool.execute(
+            "SELECT id, layer, geometry, properties FROM features ORDER BY id"
+        ):
+            geometry = wkb.loads(bytes(data))
+            if tolerance > 0 and geometry.type != "Point":
+                geometry = geometry.simplify(tolerance, preserve_topology=False)
+            if geometry.is_empty:
+                continue
+            features.append((index, layer, sqlite3.Binary(geometry.wkb), (
+                json.dumps(_zoom_properties(
+                    json.loads(properties), zoom, self.label_minzoom)))))
+            col0, col1, row0, row1 = _tile_range(geometry.bounds, zoom, margin)
+            tiles.extend(
+                (column, row, index)
+                for column in range(col0, col1 + 1)
+                for row in range(row0, row1 + 1))
+            if len(features) >= self.batch_size:
+                _flush_zoom(cursor, features, tiles)
+                features, tiles = [], []
+        _flush_zoom(cursor, features, tiles)
+        spool.execute(
+            "CREATE INDEX tile_features_index ON tile_features "
+            "(tile_column, tile_row)")
+        spool.commit()
+
+
+def tile_writer(parsed, layer):
+    """Return an MBTilesWriter if the output is an .mbtiles file."""
+    if not parsed.output.lower().endswith(".mbtiles"):
+        return None
+    return MBTilesWriter(
+        parsed.output, parsed.minzoom, parsed.maxzoom, parsed.jobs,
+        parsed.tile_buffer, parsed.tile_simplify, parsed.label_minzoom,
+        name=layer)
+
+
+class _Layer(object):
+    """Sink of the features of one layer of an MBTilesWriter."""
+
+    def __init__(self, writer, name):
+        self.writer = writer
+        self.name = name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def write(self, feature):
+        self.writer.write(feature, self.name)
+
+
+def _create_spool(filename):
+    """Create the temporary feature store of an MBTilesWriter."""
+    if os.path.isfile(filename):
+        os.remove(filename)
+    connection = sqlite3.connect(filename)
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.executescript("""
+        CREATE TABLE features (
+            id INTEGER PRIMARY KEY, layer TEXT, geometry BLOB,
+            properties TEXT);
+        CREATE TABLE zoom_features (
+            id INTEGER PRIMARY KEY, layer TEXT, geometry BLOB,
+            properties TEXT);
+        CREATE TABLE tile_features (
+            tile_column INTEGER, tile_row INTEGER, id INTEGER);
+    """)
+    return connection
+
+
+def _flush_zoom(cursor, features, tiles):
+    cursor.executemany(
+        "INSERT INTO zoom_features VALUES (?, ?, ?, ?)", features)
+    cursor.executemany("INSERT INTO tile_features VALUES (?, ?, ?)", tiles)
+
+
+_spools = {}
+
+
+def _spool_connection(filename):
+    """Return the spool connection of this (worker) process."""
+    key = (os.getpid(), filename)
+    if key not in _spools:
+        _spools[key] = sqlite3.connect(filename)
+    return _spools[key]
+
+
+def _encode_tile(task, spool=None):
+    """Clip and encode the features of one tile; return None if empty."""
+    filename, buffer, zoom, column, row = task
+    spool = spool or _spool_connection(filename)
+    bounds = tile_bounds(zoom, column, row)
+    margin = buffer * (bounds[2] - bounds[0]) / TILE_SIZE
+    clip_box = box(
+        bounds[0] - margin, bounds[1] - margin,
+        bounds[2] + margin, bounds[3] + margin)
+    layers = defaultdict(list)
+    for layer, data, properties in spool.execute(
+        "SELECT layer, geometry, properties FROM tile_features "
+        "JOIN zoom_features USING (id) "
+        "WHERE tile_column = ? AND tile_row = ? ORDER BY id", (column, row)
+    ):
+        geometry = wkb.loads(bytes(data))
+        clipped = clip_box.intersection(geometry)
+        if clipped.type == "GeometryCollection":
+            clipped = _drop_degenerate(clipped, geometry.type)
+        if clipped is None or clipped.is_empty:
+            continue
+        layers[layer].append({
+            "geometry": clipped, "properties": json.loads(properties)})
+    if not layers:
+        return None
+    data = _encode([
+        {"name": layer, "features": layer_features}
+        for layer, layer_features in sorted(layers.items())], bounds)
+    # MBTiles rows are counted from the bottom (TMS)
+    return zoom, column, 2 ** zoom - 1 - row, _gzip(data)
+
+
+def _encode(layers, bounds):
+    """Encode the layers of one tile with the installed vector tile API."""
+    import mapbox_vector_tile
+    try:
+        return mapbox_vector_tile.encode(layers, default_options={
+            "quantize_bounds": bounds, "extents": EXTENT})
+    except TypeError:
+        # mapbox_vector_tile < 2.0
+        return mapbox_vector_tile.encode(
+            layers, quantize_bounds=bounds, extents=EXTENT)
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _drop_degenerate(collection, geom_type):
+    """Return the parts of a clipping result of the input dimension."""
+    dimension = _dimension(geom_type)
+    parts = [
+        single for part in collection.geoms
+        if _dimension(part.type) == dimension
+        for single in (
+            part.geoms if part.type.startswith("Multi") else [part])]
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    return (MultiPoint, MultiLineString, MultiPolygon)[dimension](parts)
+
+
+def _dimension(geom_type):
+    return (
+        0 if "Point" in geom_type else 1 if "LineString" in geom_type else 2)
+
+
+def tile_bounds(zoom, column, row):
+    """Return the Mercator bounds of an XYZ tile."""
+    size = 2 * ORIGIN / 2 ** zoom
+    left = -ORIGIN + column * size
+    top = ORIGIN - row * size
+    return (left, top - size, left + size, top)
+
+
+def _tile_range(bounds, zoom, margin):
+    """Return the first and last column and row of the tiles of bounds."""
+    count = 2 ** zoom
+    size = 2 * ORIGIN / count
+    left, bottom, right, top = bounds
+    return np.clip(np.floor([
+        (left - margin + ORIGIN) / size,
+        (right + margin + ORIGIN) / size,
+        (ORIGIN - top - margin) / size,
+        (ORIGIN - bottom + margin) / size,
+    ]).astype(int), 0, count - 1).tolist()
+
+
+def _zoom_properties(properties, zoom, label_minzoom):
+    """Return the attributes written at a zoom level."""
+    return dict(
+        (key, value) for key, value in properties.items()
+        if value is not None and key not in DROPPED_FIELDS and not (
+            zoom < label_minzoom and key in LABEL_FIELDS))
+
+
+def _field_type(value):
+    if isinstance(value, bool):
+        return "Boolean"
+    elif isinstance(value, numbers.Number):
+        return "Number"
+    return "String"
+
+
+def _project(geometry):
+    """Yield the Antimeridian split, Mercator projected parts of a geometry."""
+    geom = shape(geometry)
+    parts = []
+    for single in singles(geom):
+        if single.type == "Point":
+            parts.append(single)
+        else:
+            parts.extend(singles(split_antimeridian(single)))
+    for part in parts:
+        part = MERCATOR_BOUNDS.intersection(part)
+        if part.type == "GeometryCollection":
+            part = _drop_degenerate(part, geom.type)
+        if part is None or part.is_empty:
+            continue
+        yield transform(mercator, part)
+
+
+def mercator(lon, lat):
+    """Project longitudes and latitudes to spherical Mercator."""
+    lon = np.asarray(lon, dtype=float)
+    lat = np.clip(np.asarray(lat, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    return (
+        EARTH_RADIUS * np.radians(lon),
+        EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)))
+
+
+def _create_schema(connection):
+    connection.executescript("""
+        CREATE TABLE metadata (name TEXT, value TEXT);
+        CREATE TABLE tiles (
+            zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+            tile_data BLOB);
+        CREATE UNIQUE INDEX tile_index ON tiles
+            (zoom_level, tile_column, tile_row);
+    """)
+
+
+def _insert_tiles(connection, tiles, batch_size=1000):
+    """Insert the tiles in transactions of batch_size tiles."""
+    batch = []
+    for zoom, column, row, data in tiles:
+        batch.append((zoom, column, row, sqlite3.Binary(data)))
+        if len(batch) >= batch_size:
+            with connection:
+                connection.executemany(
+                    "INSERT INTO tiles VALUES (?, ?, ?, ?)", batch)
+            batch = []
+    if batch:
+        with connection:
+            connection.executemany(
+                "INSERT INTO tiles VALUES (?, ?, ?, ?)", batch)
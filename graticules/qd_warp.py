@@ -28,73 +28,228 @@
 
 import sys
 import os
+import multiprocessing
 import fiona
 import argparse
 import numpy as np
-import matplotlib.pyplot as plt
-from shapely.geometry import Point, LineString, mapping, shape
+from shapely.geometry import LineString, mapping
 from affine import Affine
-import rasterstats
-from eoxmagmod import convert, GEODETIC_ABOVE_WGS84, GEOCENTRIC_SPHERICAL
-from eoxmagmod.qd import eval_qdlatlon
+from skimage.measure import find_contours
+
+# profiling.py is shared with the scripts of the parent directory
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profiling
+from qdgrid import DECIMAL_YEAR, BOUNDS, qd_grid, evict_cache
+from mbtiles import tile_writer
+
+# output drivers without layers
+SINGLE_LAYER_DRIVERS = ("ESRI Shapefile", "GeoJSON", "CSV")
 
 
 def main(args):
     """Parse arguments and run graticule creation."""
     parser = argparse.ArgumentParser()
     parser.add_argument("output", type=str, help="output vector data")
-    parser.add_argument("stepsize", type=int, help="degree step size")
+    parser.add_argument(
+        "stepsize", type=int, nargs="+", help="degree step size(s)")
     parser.add_argument(
         "--size_x", type=int, help="model raster x size", default=8192)
     parser.add_argument(
         "--size_y", type=int, help="model raster y size", default=4096)
     parser.add_argument(
-        "--driver", type=str, help="output driver", default="ESRI Shapefile")
+        "--driver", type=str, default=None,
+        help="output driver, ESRI Shapefile or GPKG for several layers")
+    parser.add_argument(
+        "--epoch", type=float, nargs="+", help="decimal year(s)",
+        default=[DECIMAL_YEAR])
+    parser.add_argument(
+        "--epoch_range", type=float, nargs=3, metavar=("START", "END", "STEP"),
+        help="decimal years from START to END (inclusive) by STEP",
+        default=None)
+    parser.add_argument(
+        "--tile_rows", type=int, help="model raster rows evaluated at once",
+        default=256)
+    parser.add_argument(
+        "--jobs", type=int, help="number of worker processes", default=1)
+    parser.add_argument(
+        "--float32", action="store_true",
+        help="store the model raster in single precision")
+    parser.add_argument(
+        "--adaptive", action="store_true",
+        help="refine the model raster adaptively from a coarse grid")
+    parser.add_argument(
+        "--tolerance", type=float,
+        help="adaptive refinement tolerance in degrees", default=0.01)
+    parser.add_argument(
+        "--coarse_step", type=int,
+        help="adaptive refinement coarse grid step in pixels", default=64)
+    parser.add_argument(
+        "--cache_dir", type=str, help="model raster cache directory",
+        default=None)
+    parser.add_argument(
+        "--cache_max_size", type=float,
+        help="maximum model raster cache size in MB", default=None)
+    parser.add_argument(
+        "--cache_max_age", type=float,
+        help="maximum model raster cache entry age in days", default=None)
+    parser.add_argument(
+        "--minzoom", type=int, help="minimum zoom of .mbtiles output",
+        default=0)
+    parser.add_argument(
+        "--maxzoom", type=int, help="maximum zoom of .mbtiles output",
+        default=6)
+    parser.add_argument(
+        "--tile_buffer", type=float, help="vector tile buffer in pixels",
+        default=4.)
+    parser.add_argument(
+        "--tile_simplify", type=float,
+        help="vector tile simplification tolerance in pixels", default=0.5)
+    parser.add_argument(
+        "--label_minzoom", type=int,
+        help="minimum zoom of vector tile label attributes", default=3)
+    profiling.add_arguments(parser)
     parsed = parser.parse_args(args)
+    profiling.configure(parsed.metrics_file, parsed.profile)
 
     output_file = parsed.output
-    stepsize = parsed.stepsize
-    size_x = parsed.size_x
-    size_y = parsed.size_y
+    stepsizes = parsed.stepsize
+    epochs = parsed.epoch
+    if parsed.epoch_range:
+        start, end, step = parsed.epoch_range
+        epochs = [
+            float(round(epoch, 6))
+            for epoch in np.arange(start, end + 0.5 * step, step)]
+
+    grid_options = dict(
+        size_x=parsed.size_x, size_y=parsed.size_y, bounds=BOUNDS,
+        elevation=0, tile_rows=parsed.tile_rows,
+        dtype="float32" if parsed.float32 else "float64",
+        cache_dir=parsed.cache_dir, cache_max_size=parsed.cache_max_size,
+        cache_max_age=parsed.cache_max_age,
+        adaptive=dict(
+            tolerance=parsed.tolerance, coarse_step=parsed.coarse_step
+        ) if parsed.adaptive else None)
+
+    # Several epochs or intervals go into separate layers of one output.
+    multilayer = len(epochs) > 1 or len(stepsizes) > 1
+    driver = parsed.driver or ("GPKG" if multilayer else "ESRI Shapefile")
+    is_tiled = output_file.lower().endswith(".mbtiles")
+    if multilayer and not is_tiled and (
+        driver in SINGLE_LAYER_DRIVERS or
+        output_file.lower().endswith(".shp")
+    ):
+        parser.error(
+            "%d layers of several intervals or epochs need a multi-layer "
+            "output, e.g. a .gpkg file with --driver GPKG" % (
+                len(epochs) * len(stepsizes)))
+
+    if os.path.isfile(output_file):
+        os.remove(output_file)
+    tiles = tile_writer(parsed, "graticules")
+
+    if parsed.jobs > 1 and len(epochs) > 1:
+        # Parallel over epochs, each grid is evaluated by a single process.
+        pool = multiprocessing.Pool(parsed.jobs)
+        layers = (
+            (epoch, stepsize, features)
+            for epoch, results in profiling.merged(pool.imap(
+                profiling.worker(_graticules_task), [
+                    # the cache is evicted by the parent once all workers
+                    # are done so that no worker removes another's entry
+                    (epoch, stepsizes, dict(
+                        grid_options, jobs=1, cache_max_size=None,
+                        cache_max_age=None))
+                    for epoch in epochs]))
+            for stepsize, features in results)
+    else:
+        pool = None
+        layers = (
+            (epoch, stepsize, features)
+            for epoch in epochs
+            for stepsize, features in graticules(
+                epoch, stepsizes, dict(grid_options, jobs=parsed.jobs)))
+
+    out_schema = dict(
+        geometry="LineString",
+        properties=dict(
+            degrees="int", direction="str", display="str", dd="float",
+            scalerank="int"))
+    if multilayer:
+        out_schema["properties"].update(epoch="float", interval="int")
+    try:
+        for epoch, stepsize, features in layers:
+            layer = dict(layer="qd_%g_%d" % (epoch, stepsize)) if (
+                multilayer) else {}
+            if tiles is not None:
+                dst_layer = tiles.layer(layer.get("layer", "graticules"))
+            else:
+                dst_layer = fiona.open(
+                    output_file, "w", schema=out_schema,
+                    crs={'init': 'epsg:4326'}, driver=driver, **layer)
+            with dst_layer as dst:
+                for feature in features:
+                    if multilayer:
+                        feature["properties"].update(
+                            epoch=epoch, interval=stepsize)
+                    with profiling.stage("write"):
+                        dst.write(feature)
+        if tiles is not None:
+            with profiling.stage("write_tiles"):
+                tiles.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if tiles is not None:
+            tiles.discard()
+    if pool is not None and parsed.cache_dir:
+        evict_cache(
+            parsed.cache_dir, parsed.cache_max_size, parsed.cache_max_age)
+    profiling.finish(script="qd_warp", output=output_file)
+
+
+def graticules(decimal_year, stepsizes, grid_options, fieldname="dd"):
+    """
+    Yield (stepsize, features) of graticules for one epoch.
+
+    The QD model raster is computed (or loaded from the cache) once and
+    shared by all step sizes.
+    """
+    lat, lon = qd_grid(decimal_year, **grid_options)
+    for stepsize in stepsizes:
+        yield stepsize, graticule_features(
+            lat, lon, grid_options["bounds"], stepsize, fieldname,
+            jobs=grid_options.get("jobs", 1))
 
-    fieldname = "dd"
-    elevation = 0
-    bounds = (-180., -90., 180., 90.)
+
+def _graticules_task(task):
+    """Compute graticules of one epoch in a worker process."""
+    decimal_year, stepsizes, grid_options = task
+    return decimal_year, [
+        (stepsize, list(features))
+        for stepsize, features in graticules(
+            decimal_year, stepsizes, grid_options)]
+
+
+def graticule_features(
+    lat, lon, bounds, stepsize, fieldname="dd", jobs=1
+):
+    """Yield latitude, longitude and meridian features from QD rasters."""
     left, bottom, right, top = bounds
+    size_y, size_x = lat.shape
     pixel_x_size = (right - left) / float(size_x)
     pixel_y_size = (top - bottom) / float(size_y)
     affine = Affine.translation(left, top) * Affine.scale(
         pixel_x_size, -pixel_y_size)
 
-    if os.path.isfile(output_file):
-        os.remove(output_file)
-
-    lons, lats = np.meshgrid(
-        np.linspace(left, right, size_x, endpoint=True),
-        np.linspace(top, bottom, size_y, endpoint=True)
-    )
-
-    # Geodetic coordinates with elevation above the WGS84 ellipsoid.
-    coord_gdt = np.empty((size_y, size_x, 3))
-    coord_gdt[:, :, 0] = lats
-    coord_gdt[:, :, 1] = lons
-    coord_gdt[:, :, 2] = elevation
-    decimal_year = np.empty((size_y, size_x))
-    decimal_year.fill(2016.1)
-    coord_gct = convert(coord_gdt, GEODETIC_ABOVE_WGS84, GEOCENTRIC_SPHERICAL)
-    qd_lat, qd_lon = eval_qdlatlon(
-        coord_gct[..., 0].ravel(), coord_gct[..., 1].ravel(),
-        coord_gct[..., 2].ravel(), decimal_year.ravel())
-
     # Latitudes
-    lat = np.reshape(qd_lat, (size_y, size_x))
-    lat_lines = extract_contours(lat, bounds, stepsize, fieldname, 0)
+    lat_lines = extract_contours(lat, bounds, stepsize, fieldname, 0, jobs)
 
     # Longitudes
-    lon = np.reshape(qd_lon, (size_y, size_x))
     lon_lines = extract_contours(
-        np.absolute(lon), bounds, stepsize, fieldname, 0)
-    meridians = extract_contours(lon, bounds, stepsize, fieldname, 0)
+        np.absolute(lon), bounds, stepsize, fieldname, 0, jobs)
+    meridians = extract_contours(lon, bounds, stepsize, fieldname, 0, jobs)
     # for row in range(len(lon)):
     #     diff = lon[row][:-1]-lon[row][1:]
     #     step_idxes = np.argwhere(diff > 180.)
@@ -102,172 +257,169 @@ def main(args):
     #         lon[row][np.argwhere(diff > 180.)[0]+1:] += 360.
     # lon_lines = extract_contours(lon, bounds, stepsize, fieldname)
 
-    out_schema = dict(
-        geometry="LineString",
-        properties=dict(
-            degrees="int", direction="str", display="str", dd="float",
-            scalerank="int"))
-    with fiona.open(
-        output_file, "w", schema=out_schema, crs={'init': 'epsg:4326'},
-        driver=parsed.driver
-    ) as dst:
-        for feature in lat_lines:
-            latitude = feature["properties"]["dd"]
-            lat_int = int(round(latitude))
-            direction = "N" if lat_int > 0 else "S"
-            display_lat = lat_int if lat_int > 0 else -lat_int
-            display = "%s %s" % (display_lat, direction)
-            if lat_int == 0:
-                direction = None
-                display = "0"
-            feature["properties"].update(
-                degrees=lat_int, direction=direction, display=display,
-                scalerank=None)
-            dst.write(feature)
-        for feature in _extract_longitudes(lon_lines, lon, affine):
-            dst.write(feature)
-            longitude = feature["properties"]["dd"]
-            lon_int = int(round(longitude))
-            direction = "W" if lon_int > 0 else "E"
-            display_lon = lon_int if lon_int > 0 else -lon_int
-            display = "%s %s" % (display_lon, direction)
-            if lon_int == 0:
-                direction = None
-                display = "0"
-            feature["properties"].update(
-                degrees=lon_int, direction=direction, display=display,
-                scalerank=None)
-            # if longitude > 180.:
-            #     feature["properties"].update(dd=longitude-360.)
-            # dst.write(feature)
+    for feature in lat_lines:
+        latitude = feature["properties"]["dd"]
+        lat_int = int(round(latitude))
+        direction = "N" if lat_int > 0 else "S"
+        display_lat = lat_int if lat_int > 0 else -lat_int
+        display = "%s %s" % (display_lat, direction)
+        if lat_int == 0:
+            direction = None
+            display = "0"
+        feature["properties"].update(
+            degrees=lat_int, direction=direction, display=display,
+            scalerank=None)
+        yield feature
+    # _extract_longitudes() sets all properties of the features
+    for feature in _extract_longitudes(lon_lines, lon, affine):
+        yield feature
 
-        for feature in meridians:
-            longitude = feature["properties"]["dd"]
-            if longitude in [0, 180]:
-                feature["properties"].update(
-                    degrees=0, direction=None, display="0", scalerank=None)
-                dst.write(feature)
+    for feature in meridians:
+        longitude = feature["properties"]["dd"]
+        if longitude in [0, 180]:
+            feature["properties"].update(
+                degrees=0, direction=None, display="0", scalerank=None)
+            yield feature
 
 
 def _extract_longitudes(lon_lines, lon_array, affine):
+    """
+    Split |longitude| contours into signed longitude lines.
+
+    The contour vertices are sampled from the longitude raster in one
+    bilinear lookup per contour and the lines are cut where the sign of the
+    sampled longitude changes. Vertices outside the raster are dropped.
+    """
     for line in lon_lines:
-        out_line_coords = []
-        longitude = line["properties"]["dd"]
-        for x, y, in shape(line["geometry"]).coords:
-            point = Point(x, y)
-            rastervalue = rasterstats.gen_point_query(
-                point, lon_array, affine=affine).next()
-            if rastervalue is None:
-                continue
-
-            if not out_line_coords:
-                out_line_coords.append(point)
-                if rastervalue >= 0.:
-                    current_is_positive = True
-                else:
-                    current_is_positive = False
-
-            if rastervalue >= 0.:
-                if current_is_positive:
-                    out_line_coords.append(point)
-                else:
-                    out_line_coords.append(point)
-                    out_line = line
-                    out_line.update(
-                        geometry=mapping(LineString(out_line_coords)))
-                    # longitude = -longitude
-                    lon_int = int(round(-longitude))
-                    direction = "W" if lon_int > 0 else "E"
-                    display_lon = lon_int if lon_int > 0 else -lon_int
-                    display = "%s %s" % (display_lon, direction)
-                    if lon_int == 0:
-                        direction = None
-                        display = "0"
-                    out_line["properties"].update(
-                        dd=-longitude, degrees=lon_int, direction=direction,
-                        display=display, scalerank=None)
-                    out_line_coords = []
-                    yield out_line
-            elif rastervalue < 0.:
-                if current_is_positive:
-                    out_line_coords.append(point)
-                    out_line = line
-                    out_line.update(
-                        geometry=mapping(LineString(out_line_coords)))
-                    lon_int = int(round(longitude))
-                    direction = "W" if lon_int > 0 else "E"
-                    display_lon = lon_int if lon_int > 0 else -lon_int
-                    display = "%s %s" % (display_lon, direction)
-                    if lon_int == 0:
-                        direction = None
-                        display = "0"
-                    out_line["properties"].update(
-                        dd=longitude, degrees=lon_int, direction=direction,
-                        display=display, scalerank=None)
-                    out_line_coords = []
-                    yield out_line
-                else:
-                    out_line_coords.append(point)
-
-        if out_line_coords:
-            if not current_is_positive:
-                longitude = -longitude
-            out_line = line
-            out_line.update(
-                geometry=mapping(LineString(out_line_coords)))
-            lon_int = int(round(longitude))
-            direction = "W" if lon_int > 0 else "E"
-            display_lon = lon_int if lon_int > 0 else -lon_int
-            display = "%s %s" % (display_lon, direction)
-            if lon_int == 0:
-                direction = None
-                display = "0"
-            out_line["properties"].update(
-                dd=longitude, degrees=lon_int, direction=direction,
-                display=display, scalerank=None)
-            out_line_coords = []
-            yield out_line
-
-
-def extract_contours(array, bounds, interval=100, field='elev', round_=0):
+        with profiling.stage("_extract_longitudes"):
+            features = list(_split_longitude(line, lon_array, affine))
+        for feature in features:
+            yield feature
+
+
+def _split_longitude(line, lon_array, affine):
+    """Yield the signed longitude lines of one |longitude| contour."""
+    longitude = line["properties"]["dd"]
+    coords = np.asarray(line["geometry"]["coordinates"], dtype=float)
+    values = _sample_bilinear(lon_array, affine, coords[:, 0], coords[:, 1])
+    valid = ~np.isnan(values)
+    coords, positive = coords[valid], values[valid] >= 0.
+    if not len(coords):
+        return
+    # Each run of equal sign ends with the first vertex of the next one.
+    starts = np.concatenate((
+        [0], np.flatnonzero(positive[1:] != positive[:-1]) + 1))
+    ends = np.append(starts[1:] + 1, len(coords))
+    for start, end in zip(starts, ends):
+        if end - start < 2:
+            continue
+        dd = longitude if positive[start] else -longitude
+        properties = dict(line["properties"])
+        properties.update(_longitude_properties(dd))
+        yield {
+            "properties": properties,
+            "geometry": mapping(LineString(coords[start:end])),
+        }
+
+
+def _longitude_properties(longitude):
+    """Return attributes of a signed longitude line."""
+    lon_int = int(round(longitude))
+    direction = "W" if lon_int > 0 else "E"
+    display_lon = lon_int if lon_int > 0 else -lon_int
+    display = "%s %s" % (display_lon, direction)
+    if lon_int == 0:
+        direction = None
+        display = "0"
+    return dict(
+        dd=longitude, degrees=lon_int, direction=direction, display=display,
+        scalerank=None)
+
+
+def _sample_bilinear(array, affine, xs, ys):
+    """
+    Sample raster values at map coordinates.
+
+    Values are interpolated bilinearly between the four surrounding pixel
+    centres; points without a full 2x2 neighbourhood get NaN.
+    """
+    cols, rows = ~affine * (np.asarray(xs), np.asarray(ys))
+    cols = cols - 0.5
+    rows = rows - 0.5
+    col0 = np.floor(cols).astype(int)
+    row0 = np.floor(rows).astype(int)
+    inside = (
+        (col0 >= 0) & (col0 < array.shape[1] - 1) &
+        (row0 >= 0) & (row0 < array.shape[0] - 1))
+    values = np.full(len(cols), np.nan)
+    col0, row0 = col0[inside], row0[inside]
+    dx, dy = cols[inside] - col0, rows[inside] - row0
+    values[inside] = (
+        array[row0, col0] * (1 - dx) * (1 - dy) +
+        array[row0, col0 + 1] * dx * (1 - dy) +
+        array[row0 + 1, col0] * (1 - dx) * dy +
+        array[row0 + 1, col0 + 1] * dx * dy)
+    return values
+
+
+def extract_contours(
+    array, bounds, interval=100, field='elev', round_=0, jobs=1
+):
     """
     Extract contour lines from an array in a given interval.
 
-    Returns GeoJSON-like dictionary.
+    The lines are traced by marching squares level by level, optionally in
+    parallel worker processes, and yielded as GeoJSON-like dictionaries as
+    soon as their level is done.
     """
+    global _contour_array
     levels = _get_contour_values(
         array.min(), array.max(), interval=interval)
     if not levels:
-        return []
-    try:
-        contours = plt.contour(array, levels)
-    except:
-        raise
-    index = 0
-    out_contours = []
+        return
     left, bottom, right, top = bounds
-    pixel_x_size = (right - left) / (array.shape[1] - 1)
-    pixel_y_size = (top - bottom) / (array.shape[0] - 1)
-    for level in range(len(contours.collections)):
-        elevation = levels[index]
-        index += 1
-        paths = contours.collections[level].get_paths()
-        for path in paths:
-            out_coords = [
-                (
-                    left+(i[1]*pixel_x_size),
-                    top-(i[0]*pixel_y_size),
-                )
-                for i in zip(path.vertices[:, 1], path.vertices[:, 0])
-            ]
-            if len(out_coords) >= 2:
-                line = LineString(out_coords)
-                out_contours.append({
-                        'properties': {field: elevation},
-                        'geometry': mapping(line)
-                })
-
-    return out_contours
+    scale = np.array([
+        (right - left) / (array.shape[1] - 1),
+        -(top - bottom) / (array.shape[0] - 1)])
+    offset = np.array([left, top])
+
+    if jobs > 1:
+        # The workers inherit the array from the forked parent process.
+        _contour_array = array
+        pool = multiprocessing.Pool(jobs)
+        results = profiling.merged(
+            pool.imap(profiling.worker(_contour_level), levels))
+    else:
+        pool = None
+        results = (_contour_level(level, array) for level in levels)
+    try:
+        for level, lines in results:
+            with profiling.stage("extract_contours"):
+                features = [
+                    {
+                        'properties': {field: level},
+                        'geometry': mapping(LineString(
+                            line[:, ::-1] * scale + offset))
+                    }
+                    for line in lines if len(line) >= 2]
+            for feature in features:
+                yield feature
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            _contour_array = None
+
+
+_contour_array = None
+
+
+def _contour_level(level, array=None):
+    """Return level and (row, col) vertex arrays of its contour lines."""
+    if array is None:
+        array = _contour_array
+    with profiling.stage("find_contours"):
+        return level, find_contours(array, level)
 
 
 def _stretch(array, target_min=0., target_max=180.):
@@ -0,0 +1,344 @@
+"""Evaluates and caches QD latitude and longitude grids."""
+
+# ------------------------------------------------------------------------------
+# Copyright (C) 2016 EOX IT Services GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies of this Software or works derived from this Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# ------------------------------------------------------------------------------
+
+import sys
+import os
+import glob
+import json
+import time
+import hashlib
+import multiprocessing
+import numpy as np
+import eoxmagmod
+from eoxmagmod import convert, GEODETIC_ABOVE_WGS84, GEOCENTRIC_SPHERICAL
+from eoxmagmod.qd import eval_qdlatlon
+from geometry import wrap
+
+# profiling.py is shared with the scripts of the parent directory
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profiling
+
+DECIMAL_YEAR = 2016.1
+BOUNDS = (-180., -90., 180., 90.)
+# cache entries of the QD grids and of the inverse warp index (warp.py)
+CACHE_PATTERNS = ("*_qd_l??.npy", "*_qd_inverse.pickle")
+
+
+def qd_grid(
+    decimal_year, size_x, size_y, bounds, elevation=0, cache_dir=None,
+    cache_max_size=None, cache_max_age=None, adaptive=None, **kwargs
+):
+    """
+    Return QD latitude and longitude grids, cached if cache_dir is set.
+
+    If adaptive is a dictionary of eval_qd_grid_adaptive() options the grid
+    is refined adaptively instead of evaluated at every point.
+    """
+    if cache_dir:
+        return cached_qd_grid(
+            cache_dir, size_x, size_y, bounds, elevation, decimal_year,
+            max_size=cache_max_size, max_age=cache_max_age,
+            adaptive=adaptive, **kwargs)
+    if adaptive:
+        return eval_qd_grid_adaptive(
+            size_x, size_y, bounds, elevation, decimal_year,
+            dtype=kwargs.get("dtype", "float64"), **adaptive)
+    return eval_qd_grid(
+        size_x, size_y, bounds, elevation, decimal_year, **kwargs)
+
+
+def eval_qd_grid(
+    size_x, size_y, bounds, elevation=0, decimal_year=DECIMAL_YEAR,
+    tile_rows=256, jobs=1, dtype="float64"
+):
+    """
+    Evaluate QD latitudes and longitudes on a regular grid.
+
+    The grid is evaluated in tiles of rows, optionally spread over a pool of
+    worker processes, so that only the output arrays are held for the whole
+    grid. Returns (qd_lat, qd_lon) arrays of shape (size_y, size_x).
+    """
+    qd_lat = np.empty((size_y, size_x), dtype=dtype)
+    qd_lon = np.empty((size_y, size_x), dtype=dtype)
+    tiles = [
+        (row, min(row + tile_rows, size_y), size_x, size_y, bounds,
+         elevation, decimal_year)
+        for row in range(0, size_y, tile_rows)
+    ]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for row, tile_lat, tile_lon in profiling.merged(
+                pool.imap_unordered(profiling.worker(_eval_qd_tile), tiles)
+            ):
+                qd_lat[row:row+len(tile_lat)] = tile_lat
+                qd_lon[row:row+len(tile_lon)] = tile_lon
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for row, tile_lat, tile_lon in map(_eval_qd_tile, tiles):
+            qd_lat[row:row+len(tile_lat)] = tile_lat
+            qd_lon[row:row+len(tile_lon)] = tile_lon
+    return qd_lat, qd_lon
+
+
+def eval_qd_grid_adaptive(
+    size_x, size_y, bounds, elevation=0, decimal_year=DECIMAL_YEAR,
+    tolerance=0.01, coarse_step=64, dtype="float64", max_fill_points=2**22
+):
+    """
+    Evaluate QD latitudes and longitudes on a regular grid adaptively.
+
+    The model is evaluated on a coarse grid of every coarse_step-th point
+    first. Cells are then split recursively, evaluating the model at the
+    centre and edge midpoints, wherever bilinear interpolation from the cell
+    corners misses these points by more than tolerance degrees or the cell
+    contains the QD longitude wrap. The remaining points are interpolated
+    from the corners of the cells which passed the check.
+
+    Returns (qd_lat, qd_lon) arrays of shape (size_y, size_x).
+    """
+    left, bottom, right, top = bounds
+    lat_step = (top - bottom) / float(size_y - 1)
+    lon_step = (right - left) / float(size_x - 1)
+    qd_lat = np.empty((size_y, size_x), dtype=dtype)
+    qd_lon = np.empty((size_y, size_x), dtype=dtype)
+    known = np.zeros((size_y, size_x), dtype=bool)
+    counter = [0]
+
+    def _evaluate(rows, cols):
+        """Evaluate the model at grid points which are not known yet."""
+        index = np.unique(np.ravel_multi_index(
+            (rows.ravel(), cols.ravel()), known.shape))
+        index = index[~known.flat[index]]
+        if not len(index):
+            return
+        rows, cols = np.unravel_index(index, known.shape)
+        coord_gdt = np.empty((len(index), 3))
+        coord_gdt[:, 0] = top - rows * lat_step
+        coord_gdt[:, 1] = left + cols * lon_step
+        coord_gdt[:, 2] = elevation
+        coord_gct = convert(
+            coord_gdt, GEODETIC_ABOVE_WGS84, GEOCENTRIC_SPHERICAL)
+        with profiling.stage("eval_qdlatlon"):
+            qd_lat.flat[index], qd_lon.flat[index] = eval_qdlatlon(
+                coord_gct[:, 0], coord_gct[:, 1], coord_gct[:, 2],
+                decimal_year)
+        known.flat[index] = True
+        counter[0] += len(index)
+
+    def _interpolate(r0, r1, c0, c1, rows, cols):
+        """Interpolate from the cell corners at the given grid points."""
+        ty = (rows - r0) / (r1 - r0).astype(float)
+        tx = (cols - c0) / (c1 - c0).astype(float)
+        w00, w01 = (1 - ty) * (1 - tx), (1 - ty) * tx
+        w10, w11 = ty * (1 - tx), ty * tx
+        lat = (
+            qd_lat[r0, c0] * w00 + qd_lat[r0, c1] * w01 +
+            qd_lat[r1, c0] * w10 + qd_lat[r1, c1] * w11)
+        # longitudes are interpolated relative to the first corner
+        base = qd_lon[r0, c0]
+        lon = base + (
+            wrap(qd_lon[r0, c1] - base) * w01 +
+            wrap(qd_lon[r1, c0] - base) * w10 +
+            wrap(qd_lon[r1, c1] - base) * w11)
+        return lat, wrap(lon)
+
+    # coarse grid
+    rows = np.unique(np.append(np.arange(0, size_y, coarse_step), size_y - 1))
+    cols = np.unique(np.append(np.arange(0, size_x, coarse_step), size_x - 1))
+    _evaluate(*np.meshgrid(rows, cols, indexing="ij"))
+    r0, c0 = [a.ravel() for a in np.meshgrid(rows[:-1], cols[:-1], indexing="ij")]
+    r1, c1 = [a.ravel() for a in np.meshgrid(rows[1:], cols[1:], indexing="ij")]
+
+    final = []
+    while len(r0):
+        # cells without interior points are done
+        divisible = (r1 - r0 >= 2) | (c1 - c0 >= 2)
+        r0, r1, c0, c1 = r0[divisible], r1[divisible], c0[divisible], c1[divisible]
+        if not len(r0):
+            break
+        rm, cm = (r0 + r1) // 2, (c0 + c1) // 2
+        test_rows = np.stack((rm, r0, r1, rm, rm), axis=1)
+        test_cols = np.stack((cm, cm, cm, c0, c1), axis=1)
+        _evaluate(test_rows, test_cols)
+
+        lat, lon = _interpolate(
+            r0[:, None], r1[:, None], c0[:, None], c1[:, None],
+            test_rows, test_cols)
+        exact_lat = qd_lat[test_rows, test_cols]
+        exact_lon = qd_lon[test_rows, test_cols]
+        error = np.maximum(
+            np.abs(lat - exact_lat),
+            np.abs(wrap(lon - exact_lon)) * np.cos(np.radians(exact_lat)),
+        ).max(axis=1)
+        corners = np.stack((
+            qd_lon[r0, c0], qd_lon[r0, c1], qd_lon[r1, c0], qd_lon[r1, c1],
+        ), axis=1)
+        wrapped = corners.max(axis=1) - corners.min(axis=1) > 180.
+        refine = (error > tolerance) | wrapped
+
+        keep = ~refine
+        final.append((r0[keep], r1[keep], c0[keep], c1[keep]))
+
+        # split the refined cells in halves along their longer-than-one sides
+        r0, r1, c0, c1, rm, cm = [
+            a[refine] for a in (r0, r1, c0, c1, rm, cm)]
+        split_r, split_c = r1 - r0 >= 2, c1 - c0 >= 2
+        children = []
+        for rows_a, rows_b, valid_r in (
+            (r0, np.where(split_r, rm, r1), True), (rm, r1, split_r)
+        ):
+            for cols_a, cols_b, valid_c in (
+                (c0, np.where(split_c, cm, c1), True), (cm, c1, split_c)
+            ):
+                valid = np.ones(len(r0), dtype=bool) & valid_r & valid_c
+                children.append((
+                    rows_a[valid], rows_b[valid], cols_a[valid], cols_b[valid]))
+        r0, r1, c0, c1 = [np.concatenate(parts) for parts in zip(*children)]
+
+    # interpolate the points of the accepted cells, grouped by cell size
+    for r0, r1, c0, c1 in final:
+        heights, widths = r1 - r0, c1 - c0
+        for height, width in set(zip(heights.tolist(), widths.tolist())):
+            same = np.flatnonzero((heights == height) & (widths == width))
+            batch = max(1, max_fill_points // ((height + 1) * (width + 1)))
+            for start in range(0, len(same), batch):
+                cells = same[start:start+batch]
+                cell_r0 = r0[cells][:, None, None]
+                cell_c0 = c0[cells][:, None, None]
+                rows = cell_r0 + np.arange(height + 1)[None, :, None]
+                cols = cell_c0 + np.arange(width + 1)[None, None, :]
+                rows, cols = np.broadcast_arrays(rows, cols)
+                lat, lon = _interpolate(
+                    cell_r0, cell_r0 + height, cell_c0, cell_c0 + width,
+                    rows, cols)
+                unknown = ~known[rows, cols]
+                qd_lat[rows[unknown], cols[unknown]] = lat[unknown]
+                qd_lon[rows[unknown], cols[unknown]] = lon[unknown]
+
+    sys.stderr.write(
+        "adaptive QD grid: %d of %d points evaluated\n" % (
+            counter[0], size_x * size_y))
+    return qd_lat, qd_lon
+
+
+def cached_qd_grid(
+    cache_dir, size_x, size_y, bounds, elevation=0, decimal_year=DECIMAL_YEAR,
+    max_size=None, max_age=None, dtype="float64", adaptive=None, **kwargs
+):
+    """
+    Return QD latitude and longitude grids from an on-disk cache.
+
+    The grids are stored as .npy files named after a hash of the grid
+    parameters and the eoxmagmod version, computed by eval_qd_grid() on
+    a cache miss, and returned memory-mapped. Afterwards, entries older than
+    max_age days and, if the cache exceeds max_size MB, the least recently
+    used entries are evicted.
+    """
+    parameters = dict(
+        size_x=size_x, size_y=size_y, bounds=list(bounds),
+        elevation=elevation, decimal_year=decimal_year, dtype=dtype,
+        eoxmagmod=getattr(eoxmagmod, "__version__", None),
+    )
+    if adaptive:
+        parameters.update(adaptive=adaptive)
+    key = hashlib.sha1(
+        json.dumps(parameters, sort_keys=True).encode("utf-8")).hexdigest()
+    lat_file = os.path.join(cache_dir, "%s_qd_lat.npy" % key)
+    lon_file = os.path.join(cache_dir, "%s_qd_lon.npy" % key)
+
+    if not (os.path.isfile(lat_file) and os.path.isfile(lon_file)):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        if adaptive:
+            qd_lat, qd_lon = eval_qd_grid_adaptive(
+                size_x, size_y, bounds, elevation, decimal_year, dtype=dtype,
+                **adaptive)
+        else:
+            qd_lat, qd_lon = eval_qd_grid(
+                size_x, size_y, bounds, elevation, decimal_year, dtype=dtype,
+                **kwargs)
+        for filename, array in ((lat_file, qd_lat), (lon_file, qd_lon)):
+            # write and rename so that no partial entry is ever visible
+            tmp_file = "%s.%d.tmp" % (filename, os.getpid())
+            with open(tmp_file, "wb") as dst:
+                np.save(dst, array)
+            os.rename(tmp_file, filename)
+        del qd_lat, qd_lon
+    else:
+        # mark the entry as recently used
+        os.utime(lat_file, None)
+        os.utime(lon_file, None)
+
+    evict_cache(cache_dir, max_size, max_age, keep=(lat_file, lon_file))
+    return (
+        np.load(lat_file, mmap_mode="r"), np.load(lon_file, mmap_mode="r"))
+
+
+def evict_cache(cache_dir, max_size=None, max_age=None, keep=()):
+    """Remove cache files by age and size, oldest first."""
+    if max_size is None and max_age is None:
+        return
+    entries = sorted(
+        (os.path.getmtime(path), os.path.getsize(path), path)
+        for pattern in CACHE_PATTERNS
+        for path in glob.glob(os.path.join(cache_dir, pattern)))
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if path in keep:
+            continue
+        too_old = max_age is not None and now - mtime > max_age * 86400
+        too_big = max_size is not None and total > max_size * 1024 * 1024
+        if not (too_old or too_big):
+            continue
+        os.remove(path)
+        total -= size
+
+
+def _eval_qd_tile(tile):
+    """Evaluate QD coordinates of one tile of grid rows."""
+    row_start, row_end, size_x, size_y, bounds, elevation, decimal_year = tile
+    left, bottom, right, top = bounds
+    lats = np.linspace(top, bottom, size_y, endpoint=True)[row_start:row_end]
+    lons = np.linspace(left, right, size_x, endpoint=True)
+
+    # Geodetic coordinates with elevation above the WGS84 ellipsoid.
+    coord_gdt = np.empty((len(lats), size_x, 3))
+    coord_gdt[:, :, 0] = lats[:, np.newaxis]
+    coord_gdt[:, :, 1] = lons
+    coord_gdt[:, :, 2] = elevation
+    coord_gct = convert(coord_gdt, GEODETIC_ABOVE_WGS84, GEOCENTRIC_SPHERICAL)
+    with profiling.stage("eval_qdlatlon"):
+        qd_lat, qd_lon = eval_qdlatlon(
+            coord_gct[..., 0].ravel(), coord_gct[..., 1].ravel(),
+            coord_gct[..., 2].ravel(), decimal_year)
+    return (
+        row_start,
+        np.reshape(qd_lat, (len(lats), size_x)),
+        np.reshape(qd_lon, (len(lats), size_x)),
+    )
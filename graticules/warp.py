@@ -28,12 +28,34 @@
 
 import os
 import sys
+import time
+import json
+import pickle
+import hashlib
 import argparse
+import multiprocessing
+from collections import deque
+from functools import partial
+from itertools import islice, chain
+import numpy as np
 import fiona
 from shapely.geometry import (
-    shape, mapping, box, LineString, MultiLineString, GeometryCollection)
+    shape, mapping, Point, LineString, Polygon, MultiPoint,
+    MultiLineString, MultiPolygon)
+import eoxmagmod
 from eoxmagmod import convert, GEODETIC_ABOVE_WGS84, GEOCENTRIC_SPHERICAL
 from eoxmagmod.qd import eval_qdlatlon
+from qdgrid import qd_grid, BOUNDS, evict_cache
+from mbtiles import tile_writer
+from geometry import wrap, singles, unwrap, unwrap_ring, split_antimeridian
+
+# profiling.py is shared with the scripts of the parent directory
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profiling
+
+
+DECIMAL_YEAR = 2016.0
 
 
 def main(args):
@@ -41,76 +63,659 @@ def main(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("input", type=str, help="input vector data")
     parser.add_argument("output", type=str, help="output vector data")
+    parser.add_argument(
+        "--epoch", type=float, help="decimal year", default=DECIMAL_YEAR)
+    parser.add_argument(
+        "--batch_size", type=int, help="number of features warped at once",
+        default=1000)
+    parser.add_argument(
+        "--jobs", type=int, help="number of worker processes", default=1)
+    parser.add_argument(
+        "--queue_size", type=int,
+        help="maximum number of batches in flight per worker", default=2)
+    parser.add_argument(
+        "--progress_interval", type=float,
+        help="seconds between progress reports", default=10.)
+    parser.add_argument(
+        "--grid", action="store_true",
+        help="interpolate from a QD lookup grid instead of exact evaluation")
+    parser.add_argument(
+        "--grid_size_x", type=int, help="lookup grid x size", default=3601)
+    parser.add_argument(
+        "--grid_size_y", type=int, help="lookup grid y size", default=1801)
+    parser.add_argument(
+        "--max_cell_spread", type=float, default=2.,
+        help="QD longitude spread (degrees) of grid cells evaluated exactly")
+    parser.add_argument(
+        "--check_sample", type=int, default=1000,
+        help="number of vertices checked against exact evaluation")
+    parser.add_argument(
+        "--tolerance", type=float, default=None,
+        help="densify and simplify the warped lines to this error (degrees)")
+    parser.add_argument(
+        "--inverse", action="store_true",
+        help="warp from QD to geographic coordinates")
+    parser.add_argument(
+        "--index_size_x", type=int, help="inverse index grid x size",
+        default=721)
+    parser.add_argument(
+        "--index_size_y", type=int, help="inverse index grid y size",
+        default=361)
+    parser.add_argument(
+        "--cache_dir", type=str, help="lookup grid and index cache directory",
+        default=None)
+    parser.add_argument(
+        "--cache_max_size", type=float,
+        help="maximum lookup grid and index cache size in MB", default=None)
+    parser.add_argument(
+        "--cache_max_age", type=float,
+        help="maximum lookup grid and index cache entry age in days",
+        default=None)
+    parser.add_argument(
+        "--minzoom", type=int, help="minimum zoom of .mbtiles output",
+        default=0)
+    parser.add_argument(
+        "--maxzoom", type=int, help="maximum zoom of .mbtiles output",
+        default=6)
+    parser.add_argument(
+        "--tile_buffer", type=float, help="vector tile buffer in pixels",
+        default=4.)
+    parser.add_argument(
+        "--tile_simplify", type=float,
+        help="vector tile simplification tolerance in pixels", default=0.5)
+    parser.add_argument(
+        "--label_minzoom", type=int,
+        help="minimum zoom of vector tile label attributes", default=3)
+    profiling.add_arguments(parser)
     parsed = parser.parse_args(args)
+    profiling.configure(parsed.metrics_file, parsed.profile)
 
     if os.path.isfile(parsed.output):
         os.remove(parsed.output)
 
+    if parsed.inverse:
+        transform = InverseWarper(
+            parsed.epoch, parsed.index_size_x, parsed.index_size_y,
+            cache_dir=parsed.cache_dir, cache_max_size=parsed.cache_max_size,
+            cache_max_age=parsed.cache_max_age)
+    elif parsed.grid:
+        transform = GridWarper(
+            parsed.epoch, parsed.grid_size_x, parsed.grid_size_y,
+            parsed.max_cell_spread, cache_dir=parsed.cache_dir,
+            cache_max_size=parsed.cache_max_size,
+            cache_max_age=parsed.cache_max_age)
+    else:
+        transform = partial(_magnetic_warp, decimal_year=parsed.epoch)
+
+    progress = Progress(parsed.progress_interval)
     with fiona.open(parsed.input, "r") as src:
         assert src.crs == {'init': u'epsg:4326'}
-        with fiona.open(
-            parsed.output, "w", schema=src.schema.copy(), driver=src.driver,
-            crs=src.crs
-        ) as dst:
-            for feature in src:
-                feature.update(
-                    geometry=mapping(
-                        warp_geometry(shape(feature["geometry"]))))
-                dst.write(feature)
+        tiles = tile_writer(
+            parsed, os.path.splitext(os.path.basename(parsed.input))[0])
+        if tiles is not None:
+            dst_layer = tiles
+        else:
+            dst_layer = fiona.open(
+                parsed.output, "w", schema=src.schema.copy(),
+                driver=src.driver, crs=src.crs)
+        with dst_layer as dst:
+
+            def _write(batch, result):
+                geometries, vertices, unconverged = result
+                with profiling.stage("write"):
+                    for feature, geometry in zip(batch, geometries):
+                        feature.update(geometry=geometry)
+                        dst.write(feature)
+                progress.update(len(batch), vertices, unconverged)
+
+            batches = _batches(src, parsed.batch_size)
+            if parsed.grid and not parsed.inverse and parsed.check_sample:
+                first = next(batches, [])
+                transform.report_error(
+                    [shape(feature["geometry"]) for feature in first],
+                    parsed.check_sample)
+                batches = chain([first] if first else [], batches)
+            if parsed.jobs > 1:
+                # Reader, worker pool and writer form a pipeline; the bounded
+                # queue of pending batches keeps the memory use flat and the
+                # output in the input order.
+                pool = multiprocessing.Pool(
+                    parsed.jobs, _init_worker, (transform, parsed.tolerance))
+                try:
+                    pending = deque()
+                    for batch in batches:
+                        pending.append((batch, pool.apply_async(
+                            profiling.worker(_warp_batch),
+                            (_geometries(batch),))))
+                        if len(pending) >= parsed.jobs * parsed.queue_size:
+                            batch, result = pending.popleft()
+                            _write(batch, profiling.unwrap(result.get()))
+                    while pending:
+                        batch, result = pending.popleft()
+                        _write(batch, profiling.unwrap(result.get()))
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                _init_worker(transform, parsed.tolerance)
+                for batch in batches:
+                    _write(batch, _warp_batch(_geometries(batch)))
+    progress.report()
+    profiling.finish(script="warp", input=parsed.input)
+
+
+def _batches(features, batch_size):
+    """Yield lists of up to batch_size features."""
+    features = iter(features)
+    while True:
+        batch = list(islice(features, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _geometries(batch):
+    """Return the geometries of a batch of features."""
+    return [feature["geometry"] for feature in batch]
 
 
-def warp_geometry(geom):
+_transform = None
+_tolerance = None
+
+
+def _init_worker(transform, tolerance=None):
+    """Set the coordinate transformation and tolerance of _warp_batch()."""
+    global _transform, _tolerance
+    _transform = transform
+    _tolerance = tolerance
+
+
+def _warp_batch(geometries):
+    """
+    Warp a batch of GeoJSON-like geometries.
+
+    Returns the warped geometries, the input vertex count and the number of
+    vertices the inverse warp did not converge for.
+    """
+    with profiling.stage("warp_batch"):
+        geoms = [shape(geometry) for geometry in geometries]
+        vertices = sum(
+            len(coords) for geom in geoms
+            for coords in _coordinate_parts(geom))
+        # the count of the worker process is returned with each batch
+        unconverged = getattr(_transform, "unconverged", 0)
+        warped = [
+            mapping(geom)
+            for geom in warp_geometries(
+                geoms, transform=_transform, tolerance=_tolerance)
+        ]
+        return (
+            warped, vertices,
+            getattr(_transform, "unconverged", 0) - unconverged)
+
+
+class Progress(object):
+    """
+    Report processed features and vertices and their throughput, and the
+    vertices the inverse warp did not converge for.
+    """
+
+    def __init__(self, interval=10., stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.features = 0
+        self.vertices = 0
+        self.unconverged = 0
+        self.start = self.last = time.time()
+
+    def update(self, features, vertices, unconverged=0):
+        self.features += features
+        self.vertices += vertices
+        self.unconverged += unconverged
+        if time.time() - self.last >= self.interval:
+            self.report()
+
+    def report(self):
+        self.last = time.time()
+        elapsed = max(self.last - self.start, 1e-9)
+        self.stream.write(
+            "%d features, %d vertices in %.1fs "
+            "(%.1f features/s, %.1f vertices/s)\n" % (
+                self.features, self.vertices, elapsed,
+                self.features / elapsed, self.vertices / elapsed))
+        if self.unconverged:
+            self.stream.write(
+                "warning: inverse warp not converged for %d vertices\n" %
+                self.unconverged)
+
+
+def warp_geometry(
+    geom, decimal_year=DECIMAL_YEAR, transform=None, tolerance=None
+):
     """
     Warp geometry while preserving geometry type.
 
-    Currently just works on LineString or MultiLineString geometries.
+    Works on (Multi)Point, (Multi)LineString and (Multi)Polygon geometries.
+    """
+    return warp_geometries([geom], decimal_year, transform, tolerance)[0]
+
+
+def warp_geometries(
+    geoms, decimal_year=DECIMAL_YEAR, transform=None, tolerance=None
+):
+    """
+    Warp a batch of geometries with a single model evaluation.
+
+    The vertices of all geometries are collected in one array, warped at
+    once and scattered back into the (antimeridian split) geometries.
+    transform replaces the exact evaluation, e.g., by a GridWarper or an
+    InverseWarper.
+
+    With a tolerance (degrees) the warped lines are densified where they
+    deviate from the warped input by more than the tolerance (see
+    _densify()) and then simplified to the tolerance.
     """
-    if geom.type == "LineString":
-        return _warp_geometry(geom)
-    elif geom.type == "MultiLineString":
-        return MultiLineString([_warp_geometry(geom) for line in geom])
+    if transform is None:
+        transform = partial(_magnetic_warp, decimal_year=decimal_year)
+    parts = [_coordinate_parts(geom) for geom in geoms]
+    sequences = [coords for geom_parts in parts for coords in geom_parts]
+    if sequences:
+        coords = np.concatenate(sequences)
+        qd_lon, qd_lat = transform(coords[:, 0], coords[:, 1])
+        warped = np.split(
+            np.column_stack((qd_lon, qd_lat)),
+            np.cumsum([len(coords) for coords in sequences])[:-1])
+        if tolerance:
+            warped = _densify(sequences, warped, transform, tolerance)
+    else:
+        warped = []
+
+    warped = iter(warped)
+    return [_rebuild(geom, warped, tolerance) for geom in geoms]
+
+
+def _densify(sources, warped, transform, tolerance, max_depth=8):
+    """
+    Insert vertices where warped segments miss the warped input.
+
+    The midpoints of the input segments are warped and compared with the
+    midpoints of the warped segments (chords). Segments deviating by more
+    than tolerance degrees get the warped midpoint and their halves are
+    checked again, up to max_depth times. Each round warps the midpoints of
+    all sequences at once. Returns the densified warped sequences.
+    """
+    sources = list(sources)
+    warped = list(warped)
+    check = [np.ones(max(len(coords) - 1, 0), dtype=bool) for coords in sources]
+    for _ in range(max_depth):
+        segments = [np.flatnonzero(flags) for flags in check]
+        if not sum(len(segment) for segment in segments):
+            break
+        source_mids = np.concatenate([
+            _midpoints(coords, segment)
+            for coords, segment in zip(sources, segments)])
+        mid_lon, mid_lat = transform(source_mids[:, 0], source_mids[:, 1])
+        mids = np.column_stack((mid_lon, mid_lat))
+        chords = np.concatenate([
+            _midpoints(coords, segment)
+            for coords, segment in zip(warped, segments)])
+        deviation = np.hypot(
+            wrap(mids[:, 0] - chords[:, 0]) * np.cos(np.radians(mids[:, 1])),
+            mids[:, 1] - chords[:, 1])
+        split = deviation > tolerance
+
+        start = 0
+        for index, segment in enumerate(segments):
+            end = start + len(segment)
+            selected = split[start:end]
+            split_segments = segment[selected]
+            sources[index] = np.insert(
+                sources[index], split_segments + 1,
+                source_mids[start:end][selected], axis=0)
+            warped[index] = np.insert(
+                warped[index], split_segments + 1,
+                mids[start:end][selected], axis=0)
+            # both halves of a split segment are checked in the next round
+            halves = split_segments + np.arange(len(split_segments))
+            check[index] = np.zeros(len(sources[index]) - 1, dtype=bool)
+            check[index][halves] = True
+            check[index][halves + 1] = True
+            start = end
+    return warped
+
+
+def _midpoints(coords, segments):
+    """Return the midpoints of the given segments of a coordinate array."""
+    first, second = coords[segments], coords[segments + 1]
+    return np.column_stack((
+        wrap(first[:, 0] + 0.5 * wrap(second[:, 0] - first[:, 0])),
+        0.5 * (first[:, 1] + second[:, 1])))
+
+
+def _coordinate_parts(geom):
+    """Return the coordinate arrays of a geometry in _rebuild() order."""
+    if geom.type in ("Point", "LineString"):
+        return [np.asarray(geom.coords)[:, :2]]
+    elif geom.type == "Polygon":
+        return [
+            np.asarray(ring.coords)[:, :2]
+            for ring in chain([geom.exterior], geom.interiors)]
+    elif geom.type in ("MultiPoint", "MultiLineString", "MultiPolygon"):
+        return [
+            coords for part in geom.geoms
+            for coords in _coordinate_parts(part)]
     else:
         raise IOError("invalid input geometry type: %s" % geom.type)
 
 
-def _warp_geometry(geom):
-    """Return warped geometry while correctly dealing with Antimeridian."""
-    out_geom = LineString([_magnetic_warp(x, y) for x, y in geom.coords])
-    # Geometries crossing the Antimeridian will get clipped and returned as
-    # MultiLineStrings.
-    if not WGS84_BOUNDS.contains(out_geom):
-        out_geom = MultiLineString([
-            line
-            for line in [
-                WGS84_BOUNDS.intersection(out_geom),
-                _shift_geom(
-                    WGS84_LEFT.intersection(out_geom), xoff=360, yoff=0),
-                _shift_geom(
-                    WGS84_RIGHT.intersection(out_geom), xoff=-360, yoff=0)]
-            if line.type == "LineString"  # kick out empty GeometryCollection
-        ])
-    return out_geom
-
-
-WGS84_BOUNDS = box(-180, -90, 180, 90)
-WGS84_LEFT = box(-540, -90, -180, 90)
-WGS84_RIGHT = box(180, -90, 540, 90)
-
-
-def _magnetic_warp(x, y, decimal_year=2016.0):
-    """Apply magnetic warp magic."""
-    gc_lat, gc_lon, gc_rad = convert(
-        [y, x, 0], GEODETIC_ABOVE_WGS84, GEOCENTRIC_SPHERICAL)
-    qd_lat, qd_lon = eval_qdlatlon(gc_lat, gc_lon, gc_rad, decimal_year)
+def _rebuild(geom, warped, tolerance=None):
+    """
+    Build a geometry like geom from the iterator of warped coordinates.
+
+    Lines and polygons are simplified to the optional tolerance.
+    """
+    if geom.type == "Point":
+        return Point(next(warped)[0])
+    elif geom.type == "LineString":
+        line = LineString(unwrap(next(warped)))
+        if tolerance:
+            line = line.simplify(tolerance, preserve_topology=False)
+        return split_antimeridian(line)
+    elif geom.type == "Polygon":
+        exterior = unwrap_ring(next(warped))
+        interiors = [
+            unwrap_ring(next(warped), exterior[0, 0])
+            for _ in geom.interiors]
+        polygon = Polygon(exterior, interiors)
+        if not polygon.is_valid:
+            # e.g., the spike to the warped geographic pole of a polar cap
+            polygon = polygon.buffer(0)
+        if tolerance:
+            polygon = polygon.simplify(tolerance)
+        return split_antimeridian(polygon)
+    multi = {
+        "MultiPoint": MultiPoint, "MultiLineString": MultiLineString,
+        "MultiPolygon": MultiPolygon}[geom.type]
+    return multi([
+        single
+        for part in geom.geoms
+        for single in singles(_rebuild(part, warped, tolerance))])
+
+
+def _magnetic_warp(x, y, decimal_year=DECIMAL_YEAR):
+    """Apply magnetic warp magic to arrays of longitudes and latitudes."""
+    coord_gdt = np.zeros((len(x), 3))
+    coord_gdt[:, 0] = y
+    coord_gdt[:, 1] = x
+    coord_gct = convert(coord_gdt, GEODETIC_ABOVE_WGS84, GEOCENTRIC_SPHERICAL)
+    with profiling.stage("eval_qdlatlon"):
+        qd_lat, qd_lon = eval_qdlatlon(
+            coord_gct[:, 0], coord_gct[:, 1], coord_gct[:, 2], decimal_year)
     return qd_lon, qd_lat
 
 
-def _shift_geom(geom, xoff=0, yoff=0):
-    """Shift geometry along x and/or y axis."""
-    if geom.type == "LineString":
-        return LineString([(x+xoff, y+yoff) for x, y in geom.coords])
-    else:
-        return GeometryCollection()
+class GridWarper(object):
+    """
+    Approximate magnetic warp interpolating a QD lookup grid.
+
+    The QD latitude/longitude grid of the epoch is computed by qdgrid (or
+    loaded from its cache) and vertices are warped by bilinear interpolation
+    with longitudes interpolated relative to a cell corner, which handles
+    the wrap at +/-180 degrees. Vertices in cells whose QD longitudes spread
+    over more than max_cell_spread degrees, i.e., close to the magnetic
+    poles, are evaluated exactly.
+    """
+
+    def __init__(
+        self, decimal_year=DECIMAL_YEAR, size_x=3601, size_y=1801,
+        max_cell_spread=2., cache_dir=None, cache_max_size=None,
+        cache_max_age=None
+    ):
+        self.decimal_year = decimal_year
+        self.lat, self.lon = qd_grid(
+            decimal_year, size_x, size_y, BOUNDS, cache_dir=cache_dir,
+            cache_max_size=cache_max_size, cache_max_age=cache_max_age)
+        left, bottom, right, top = BOUNDS
+        self.left, self.top = left, top
+        self.step_x = (right - left) / float(size_x - 1)
+        self.step_y = (top - bottom) / float(size_y - 1)
+
+        base = self.lon[:-1, :-1]
+        deltas = np.stack((
+            np.zeros(base.shape), wrap(self.lon[:-1, 1:] - base),
+            wrap(self.lon[1:, :-1] - base), wrap(self.lon[1:, 1:] - base),
+        ))
+        self.exact = (
+            deltas.max(axis=0) - deltas.min(axis=0) > max_cell_spread)
+
+    def __call__(self, x, y):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        cols = (x - self.left) / self.step_x
+        rows = (self.top - y) / self.step_y
+        col0 = np.clip(np.floor(cols).astype(int), 0, self.lon.shape[1] - 2)
+        row0 = np.clip(np.floor(rows).astype(int), 0, self.lon.shape[0] - 2)
+        tx, ty = cols - col0, rows - row0
+        w00, w01 = (1 - ty) * (1 - tx), (1 - ty) * tx
+        w10, w11 = ty * (1 - tx), ty * tx
+
+        lat, lon = self.lat, self.lon
+        qd_lat = (
+            lat[row0, col0] * w00 + lat[row0, col0 + 1] * w01 +
+            lat[row0 + 1, col0] * w10 + lat[row0 + 1, col0 + 1] * w11)
+        base = lon[row0, col0]
+        qd_lon = wrap(base + (
+            wrap(lon[row0, col0 + 1] - base) * w01 +
+            wrap(lon[row0 + 1, col0] - base) * w10 +
+            wrap(lon[row0 + 1, col0 + 1] - base) * w11))
+
+        exact = self.exact[row0, col0]
+        if exact.any():
+            qd_lon[exact], qd_lat[exact] = _magnetic_warp(
+                x[exact], y[exact], self.decimal_year)
+        return qd_lon, qd_lat
+
+    def max_error(self, x, y):
+        """Return the maximum latitude and longitude error in degrees."""
+        qd_lon, qd_lat = self(x, y)
+        exact_lon, exact_lat = _magnetic_warp(x, y, self.decimal_year)
+        return (
+            np.abs(qd_lat - exact_lat).max(),
+            np.abs(wrap(qd_lon - exact_lon)).max())
+
+    def report_error(self, geoms, sample_size=1000, stream=sys.stderr):
+        """Report the interpolation error on a sample of the vertices."""
+        coords = [
+            coords for geom in geoms for coords in _coordinate_parts(geom)]
+        if not coords:
+            return
+        coords = np.concatenate(coords)
+        if len(coords) > sample_size:
+            coords = coords[np.random.choice(
+                len(coords), sample_size, replace=False)]
+        lat_error, lon_error = self.max_error(coords[:, 0], coords[:, 1])
+        stream.write(
+            "grid warp maximum error on %d vertices: "
+            "%.6f deg latitude, %.6f deg longitude\n" % (
+                len(coords), lat_error, lon_error))
+
+
+class InverseWarper(object):
+    """
+    Inverse (QD to geographic) magnetic warp.
+
+    Starting points are looked up in a KD-tree built over the QD coordinates
+    (as unit vectors) of a forward QD grid and refined by vectorized Newton
+    iterations with a finite difference Jacobian of the exact forward warp.
+    The iterations move the points in the local tangent planes of the unit
+    sphere, so that they converge at the geographic poles, too.
+    The tree is pickled in cache_dir so that it is built only once; the
+    pickle is evicted like the QD grid cache entries (see qdgrid).
+
+    Points not converged within max_iterations, e.g., at the QD poles, fall
+    back to their nearest grid point and are counted in unconverged.
+    """
+
+    def __init__(
+        self, decimal_year=DECIMAL_YEAR, size_x=721, size_y=361,
+        cache_dir=None, tolerance=1e-6, max_iterations=20, max_step=5.,
+        cache_max_size=None, cache_max_age=None
+    ):
+        self.decimal_year = decimal_year
+        self.size_x, self.size_y = size_x, size_y
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.max_step = max_step
+        left, bottom, right, top = BOUNDS
+        self.left, self.top = left, top
+        self.step_x = (right - left) / float(size_x - 1)
+        self.step_y = (top - bottom) / float(size_y - 1)
+        self.tree = self._load_tree(cache_dir, cache_max_size, cache_max_age)
+        self.unconverged = 0
+
+    def _load_tree(self, cache_dir, max_size=None, max_age=None):
+        """Load the KD-tree from the cache or build it."""
+        if cache_dir:
+            key = hashlib.sha1(json.dumps(dict(
+                size_x=self.size_x, size_y=self.size_y,
+                decimal_year=self.decimal_year, bounds=list(BOUNDS),
+                eoxmagmod=getattr(eoxmagmod, "__version__", None),
+            ), sort_keys=True).encode("utf-8")).hexdigest()
+            filename = os.path.join(cache_dir, "%s_qd_inverse.pickle" % key)
+            if os.path.isfile(filename):
+                # mark the entry as recently used
+                os.utime(filename, None)
+                with open(filename, "rb") as src:
+                    tree = pickle.load(src)
+                evict_cache(cache_dir, max_size, max_age, keep=(filename,))
+                return tree
+        # scipy is only required by the inverse warp
+        from scipy.spatial import cKDTree
+
+        qd_lat, qd_lon = qd_grid(
+            self.decimal_year, self.size_x, self.size_y, BOUNDS,
+            cache_dir=cache_dir, cache_max_size=max_size,
+            cache_max_age=max_age)
+        tree = cKDTree(_unit_vectors(
+            np.ravel(qd_lon), np.ravel(qd_lat)))
+        if cache_dir:
+            tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+            with open(tmp_filename, "wb") as dst:
+                pickle.dump(tree, dst, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, filename)
+            evict_cache(cache_dir, max_size, max_age, keep=(filename,))
+        return tree
+
+    def __call__(self, qd_lon, qd_lat):
+        qd_lon = np.asarray(qd_lon, dtype=float)
+        qd_lat = np.asarray(qd_lat, dtype=float)
+        target = _unit_vectors(qd_lon, qd_lat)
+        _, index = self.tree.query(target)
+        rows, cols = np.unravel_index(index, (self.size_y, self.size_x))
+        start_lat = self.top - rows * self.step_y
+        start_lon = wrap(self.left + cols * self.step_x)
+        lat, lon = start_lat.copy(), start_lon.copy()
+
+        # Points move in the tangent planes of the unit sphere, which has no
+        # singularity at the geographic or QD poles. The last pass only
+        # checks the residual of the last update.
+        delta = np.radians(1e-4)
+        max_step = np.radians(self.max_step)
+        active = np.arange(len(lat))
+        for iteration in range(self.max_iterations + 1):
+            if not len(active):
+                break
+            last = iteration == self.max_iterations
+            point = _unit_vectors(lon[active], lat[active])
+            east, north = _tangent_basis(lon[active], lat[active])
+            lons, lats = [lon[active]], [lat[active]]
+            if not last:
+                # one model evaluation for the points and their offsets
+                for offset in (east, north):
+                    offset_lon, offset_lat = _lonlat(
+                        _move(point, offset, delta))
+                    lons.append(offset_lon)
+                    lats.append(offset_lat)
+            flon, flat = _magnetic_warp(
+                np.concatenate(lons), np.concatenate(lats), self.decimal_year)
+            warped = _unit_vectors(flon, flat).reshape(len(lons), -1, 3)
+            qd_east, qd_north = _tangent_basis(
+                flon[:len(active)], flat[:len(active)])
+
+            # residual (radians) towards the target in the QD tangent plane
+            res = _tangent_coordinates(
+                target[active] - warped[0], qd_east, qd_north)
+            norm = np.hypot(res[0], res[1])
+            distance = np.arctan2(norm, np.sum(
+                target[active] * warped[0], axis=1))
+            scale = distance / np.where(norm > 0, norm, 1.)
+            res_x, res_y = res[0] * scale, res[1] * scale
+            converged = np.degrees(distance) < self.tolerance
+            if last:
+                active = active[~converged]
+                break
+
+            # Jacobian of the QD tangent coordinates by the geographic ones
+            a, c = _tangent_coordinates(
+                (warped[1] - warped[0]) / delta, qd_east, qd_north)
+            b, d = _tangent_coordinates(
+                (warped[2] - warped[0]) / delta, qd_east, qd_north)
+            det = a * d - b * c
+            det = np.where(det == 0, np.inf, det)
+            step_x = (d * res_x - b * res_y) / det
+            step_y = (a * res_y - c * res_x) / det
+            length = np.hypot(step_x, step_y)
+            shrink = max_step / np.maximum(length, max_step)
+
+            update = ~converged
+            lon[active[update]], lat[active[update]] = _lonlat(_move(
+                point[update],
+                (east[update] * (step_x * shrink)[update, None] +
+                 north[update] * (step_y * shrink)[update, None]),
+                1.))
+            active = active[update]
+        # the last Newton step of an unconverged point may have diverged
+        lat[active], lon[active] = start_lat[active], start_lon[active]
+        self.unconverged += len(active)
+        return lon, lat
+
+
+def _unit_vectors(lon, lat):
+    """Return unit vectors of longitude/latitude arrays in degrees."""
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+    return np.column_stack(
+        (cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def _tangent_basis(lon, lat):
+    """Return the east and north unit vectors at longitudes/latitudes."""
+    lon, lat = np.radians(lon), np.radians(lat)
+    sin_lat = np.sin(lat)
+    east = np.column_stack((-np.sin(lon), np.cos(lon), np.zeros(len(lon))))
+    north = np.column_stack((
+        -sin_lat * np.cos(lon), -sin_lat * np.sin(lon), np.cos(lat)))
+    return east, north
+
+
+def _tangent_coordinates(vectors, east, north):
+    """Return the east and north components of vectors."""
+    return np.sum(vectors * east, axis=1), np.sum(vectors * north, axis=1)
+
+
+def _move(points, tangents, scale):
+    """Move unit vectors along great circles by scaled tangent vectors."""
+    tangents = tangents * scale
+    angle = np.sqrt(np.sum(tangents * tangents, axis=1))[:, None]
+    # np.sinc(x) is sin(pi * x) / (pi * x), finite at 0
+    return points * np.cos(angle) + tangents * np.sinc(angle / np.pi)
+
+
+def _lonlat(vectors):
+    """Return longitudes and latitudes in degrees of unit vectors."""
+    return (
+        np.degrees(np.arctan2(vectors[:, 1], vectors[:, 0])),
+        np.degrees(np.arcsin(np.clip(vectors[:, 2], -1., 1.))),
+    )
 
 
 if __name__ == "__main__":
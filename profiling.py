@@ -0,0 +1,267 @@
+""" Per-stage profiling and metrics shared by the scripts.
+
+The scripts mark their stages with
+
+    with profiling.stage("render"):
+        ...
+
+which is a no-op unless profiling is enabled by `configure()`. For each
+stage name the number of calls, the wall and CPU time summed over the calls
+and the memory high-water mark are recorded. Optionally each stage is also
+run under cProfile and the profile of the slowest stage is dumped at the end.
+
+Worker processes forked after `configure()` record their stages as well. The
+pool functions are wrapped by `worker()` so that the records are returned
+with the results and merged by `merged()`/`unwrap()` in the parent.
+"""
+import os
+import json
+import time
+import socket
+import pstats
+import cProfile
+import resource
+import threading
+from datetime import datetime
+
+
+def add_arguments(parser):
+    """ Add the --profile and --metrics-file options to an ArgumentParser. """
+    parser.add_argument("--metrics-file", dest="metrics_file", default=None,
+                        help="Append per-stage metrics as JSON lines to "
+                             "this file")
+    parser.add_argument("--profile", default=None,
+                        help="Write the cProfile statistics of the slowest "
+                             "stage to this file")
+
+
+def max_rss():
+    """ Get the memory high-water mark of this process in kB. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def cpu_time():
+    """ Get the user plus system CPU time of this process. """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class _ProfileStats(object):
+    """ cProfile statistics in the form accepted by pstats.Stats. """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class _Stage(object):
+    """ Context manager measuring a single call of a stage. """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.profile = None
+
+    def __enter__(self):
+        profiler = self.profiler
+        if (profiler.profile and not profiler.profiling and
+                threading.current_thread().name == "MainThread"):
+            # only the outermost stage is profiled, the profiles of nested
+            # stages are included in its statistics
+            profiler.profiling = True
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.wall = time.time()
+        self.cpu = cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.time() - self.wall
+        cpu = cpu_time() - self.cpu
+        profiler = self.profiler
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.create_stats()
+            profiler.profiles.setdefault(self.name, []).append(
+                self.profile.stats
+            )
+            profiler.profiling = False
+        profiler.add(self.name, 1, wall, cpu, max_rss())
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Profiler(object):
+    """ Collector of the per-stage metrics of one process. """
+
+    def __init__(self, enabled=False, profile=False):
+        self.enabled = enabled
+        self.profile = profile
+        self.profiling = False
+        self.start = time.time()
+        self.pid = os.getpid()
+        self.stats = {}
+        self.profiles = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, calls, wall, cpu, maxrss):
+        stats = self.stats.setdefault(name, {
+            "calls": 0, "wall": 0.0, "cpu": 0.0, "maxrss_kb": 0,
+        })
+        stats["calls"] += calls
+        stats["wall"] += wall
+        stats["cpu"] += cpu
+        stats["maxrss_kb"] = max(stats["maxrss_kb"], maxrss)
+
+    def reset(self):
+        self.stats = {}
+        self.profiles = {}
+        self.pid = os.getpid()
+
+    def collect(self):
+        """ Get and clear the records of this process. """
+        records = (self.stats, self.profiles)
+        self.reset()
+        return records
+
+    def merge(self, records):
+        """ Merge records collected by `collect()` in another process. """
+        stats, profiles = records
+        for name, item in stats.items():
+            self.add(
+                name, item["calls"], item["wall"], item["cpu"],
+                item["maxrss_kb"]
+            )
+        for name, items in profiles.items():
+            self.profiles.setdefault(name, []).extend(items)
+
+    def slowest(self):
+        """ Get the name of the profiled stage with the longest wall time. """
+        names = [name for name in self.profiles if name in self.stats]
+        if not names:
+            return None
+        return max(names, key=lambda name: self.stats[name]["wall"])
+
+    def records(self, **context):
+        """ Get the JSON records of the stages and of the whole run. Wall and
+            CPU times of a stage are summed over its calls, in all processes.
+        """
+        base = {
+            "time": datetime.utcnow().isoformat("T") + "Z",
+            "host": socket.gethostname(), "pid": os.getpid(),
+        }
+        base.update(context)
+        records = []
+        for name, stats in sorted(self.stats.items()):
+            record = dict(base, stage=name)
+            record.update(stats)
+            records.append(record)
+        times = os.times()
+        records.append(dict(
+            base, stage="total", calls=1, wall=time.time() - self.start,
+            cpu=sum(times[:4]), maxrss_kb=max(
+                max_rss(),
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            ),
+        ))
+        return records
+
+    def write(self, metrics_filename=None, profile_filename=None, **context):
+        """ Append the records to the metrics file and dump the cProfile
+            statistics of the slowest stage.
+        """
+        if metrics_filename:
+            with open(metrics_filename, "a") as f:
+                for record in self.records(**context):
+                    f.write(json.dumps(record, sort_keys=True) + "\n")
+        slowest = self.slowest()
+        if profile_filename and slowest:
+            items = self.profiles[slowest]
+            stats = pstats.Stats(_ProfileStats(items[0]))
+            for item in items[1:]:
+                stats.add(_ProfileStats(item))
+            stats.dump_stats(profile_filename)
+
+
+# profiler of this process, disabled until configured
+profiler = Profiler()
+
+_options = {}
+
+
+def configure(metrics_filename=None, profile_filename=None):
+    """ Enable profiling if a metrics or profile file is given. """
+    global profiler
+    profiler = Profiler(
+        bool(metrics_filename or profile_filename), bool(profile_filename)
+    )
+    _options.update(
+        metrics_filename=metrics_filename, profile_filename=profile_filename
+    )
+
+
+def stage(name):
+    """ Get a context manager recording a call of the named stage. """
+    return profiler.stage(name)
+
+
+def finish(**context):
+    """ Write the metrics and profile of the run. The context, e.g., the
+        script and input names, is added to every record.
+    """
+    if profiler.enabled:
+        profiler.write(**dict(_options, **context))
+
+
+class _Task(object):
+    """ Pool function returning the stage records of the worker process with
+        its result.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args):
+        if profiler.pid != os.getpid():
+            # drop the records inherited from the parent process
+            profiler.reset()
+        result = self.function(*args)
+        return result, profiler.collect()
+
+
+def worker(function):
+    """ Wrap a function executed by a process pool. """
+    return _Task(function) if profiler.enabled else function
+
+
+def unwrap(result):
+    """ Merge the records of a result of a `worker()` wrapped function and
+        get the result.
+    """
+    if not profiler.enabled:
+        return result
+    result, records = result
+    profiler.merge(records)
+    return result
+
+
+def merged(results):
+    """ Unwrap an iterable of `worker()` wrapped results. """
+    for result in results:
+        yield unwrap(result)
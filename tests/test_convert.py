@@ -0,0 +1,58 @@
+""" Tests of the CDF export. """
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+convert = pytest.importorskip("convert")
+from spacepy import pycdf
+
+
+def write_cdf(filename, time_type, size=50):
+    """ Write a synthetic input file with the default variables: float64
+        longitudes with NaNs, float32 latitudes, integer radii and float64
+        F values, with whole and fractional second timestamps.
+    """
+    samples = np.arange(size)
+    longitude = np.linspace(-180., 180., size)
+    longitude[[3, 17]] = np.nan
+    cdf = pycdf.CDF(filename, "")
+    try:
+        start = datetime(2016, 1, 1, 23, 59, 58)
+        cdf.new(
+            "Timestamp",
+            data=[start + timedelta(milliseconds=250 * i)
+                  for i in range(size)],
+            type=time_type,
+        )
+        cdf.new("Longitude", data=longitude, type=pycdf.const.CDF_DOUBLE)
+        cdf.new(
+            "Latitude", data=np.linspace(-90., 90., size).astype("float32"),
+            type=pycdf.const.CDF_FLOAT,
+        )
+        cdf.new(
+            "Radius", data=6371200 + 1000 * samples,
+            type=pycdf.const.CDF_INT4,
+        )
+        cdf.new(
+            "F", data=20000. + np.sin(samples) / 3.,
+            type=pycdf.const.CDF_DOUBLE,
+        )
+    finally:
+        cdf.close()
+
+
+@pytest.mark.parametrize("time_type", [
+    pycdf.const.CDF_EPOCH, pycdf.const.CDF_TIME_TT2000,
+])
+@pytest.mark.parametrize("chunksize", [1, 7, 65536])
+def test_chunked_csv_is_identical_to_csv_writer(tmpdir, time_type, chunksize):
+    input_filename = str(tmpdir.join("input.cdf"))
+    write_cdf(input_filename, time_type)
+    baseline = tmpdir.join("baseline.csv")
+    chunked = tmpdir.join("chunked.csv")
+
+    convert.convert(input_filename, str(baseline))
+    convert.convert_chunked(input_filename, str(chunked), chunksize)
+
+    assert chunked.read_binary() == baseline.read_binary()
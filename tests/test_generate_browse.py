@@ -0,0 +1,170 @@
+""" Tests of the browse report generation. """
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+generate_browse = pytest.importorskip("generate_browse")
+from spacepy import pycdf
+
+
+INPUT_FILENAME = "SW_OPER_MAGA_LR_1B_20160101T000000_20160101T235959_0408.cdf"
+
+
+def write_cdf(filename, size=400, changed=None, sampling=1.):
+    """ Write a synthetic input file with one record per `sampling` seconds.
+        The F values of the optional `changed` slice of records are modified.
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+    samples = np.arange(size, dtype="float64")
+    f = 20000. + 1000. * np.sin(samples / 50.)
+    if changed is not None:
+        f[changed] += 100.
+    cdf = pycdf.CDF(filename, "")
+    try:
+        start = datetime(2016, 1, 1)
+        cdf.new(
+            "Timestamp",
+            data=[start + timedelta(seconds=i * sampling)
+                  for i in range(size)],
+            type=pycdf.const.CDF_EPOCH,
+        )
+        cdf["Longitude"] = np.mod(samples, 360.) - 180.
+        cdf["Latitude"] = 80. * np.sin(samples / 100.)
+        cdf["F"] = f
+    finally:
+        cdf.close()
+
+
+@pytest.fixture
+def browse_input(tmpdir):
+    filename = str(tmpdir.join(INPUT_FILENAME))
+    write_cdf(filename)
+    return filename
+
+
+@pytest.fixture
+def rendered(monkeypatch):
+    """ Record the names of the browse images rendered by `generate`. """
+    names = []
+    render_chunk = generate_browse.render_chunk
+
+    def _render_chunk(index, browse_filename, *args, **kwargs):
+        names.append(os.path.basename(browse_filename))
+        return render_chunk(index, browse_filename, *args, **kwargs)
+
+    monkeypatch.setattr(generate_browse, "render_chunk", _render_chunk)
+    return names
+
+
+def generate_incremental(input_filename, **options):
+    """ Run an incremental generation of 100 record chunks. """
+    generate_browse.generate(
+        input_filename, input_filename + "_%s.tif", step=100,
+        manifest_filename=input_filename + ".manifest", **options
+    )
+
+
+def chunk_names(input_filename, labels):
+    return [os.path.basename(input_filename) + "_%s.tif" % label
+            for label in labels]
+
+
+# the reference grid of the former hard-coded browse report template
+OLD_REFERENCE_GRID = (
+    "        <rep:levelsNumber>104</rep:levelsNumber>\n"
+    "        <rep:heightLevelsList>"
+    "239.232 479.056 718.893 958.726 1198.527 1438.38 1678.198 1918.025 "
+    "2157.863 2397.685 2637.507 2877.35 3117.17 3357.011 3596.836 3836.667 "
+    "4076.491 4316.328 4556.144 4795.979 5035.815 5275.637 5515.458 5755.296 "
+    "5995.117 6234.956 6474.783 6714.608 6954.445 7194.282 7434.098 7673.934 "
+    "7913.766 8153.581 8393.422 8633.252 8873.07 9112.904 9352.737 9592.547 "
+    "9832.395 10072.215 10312.042 10551.875 10791.702 11031.519 11271.369 "
+    "11511.196 11751.025 11990.863 12230.685 12470.507 12710.341 12950.161 "
+    "13189.998 13429.829 13669.651 13909.474 14149.311 14389.13 14628.969 "
+    "14868.805 15108.636 15348.458 15588.296 15828.117 16067.956 16307.781 "
+    "16547.602 16787.434 17027.271 17267.081 17506.915 17746.753 17986.572 "
+    "18226.408 18466.243 18706.068 18945.904 19185.737 19425.547 19665.395 "
+    "19905.215 20145.042 20384.875 20624.702 20864.516 21104.358 21344.178 "
+    "21584.012 21823.836 22063.667 22303.491 22543.328 22783.152 23022.989 "
+    "23262.828 23502.651 23742.474 23982.311 24222.13 24461.967 24701.793 "
+    "24941.618"
+    "</rep:heightLevelsList>"
+)
+
+
+def test_default_reference_grid_is_unchanged():
+    assert generate_browse.reference_grid(104) == OLD_REFERENCE_GRID
+
+
+def test_reference_grid_levels():
+    levels = [
+        float(level) for level in
+        generate_browse.reference_grid(52).split("<rep:heightLevelsList>")[1]
+        .split("<")[0].split()
+    ]
+    assert len(levels) == 52
+    assert levels[-1] == generate_browse.MAX_HEIGHT
+    assert levels == sorted(levels)
+
+
+def test_incremental_max_height_change_regenerates_chunks(
+        browse_input, rendered):
+    generate_incremental(browse_input)
+    assert rendered == chunk_names(browse_input, [0, 1, 2])
+
+    del rendered[:]
+    generate_incremental(browse_input, max_height=20000.)
+    assert rendered == chunk_names(browse_input, [0, 1, 2])
+    with open(browse_input + "_1.xml") as f:
+        assert " 20000</rep:heightLevelsList>" in f.read()
+
+
+def test_incremental_skips_unchanged_chunks(browse_input, rendered):
+    generate_incremental(browse_input)
+    del rendered[:]
+    generate_incremental(browse_input)
+    assert rendered == []
+
+
+def test_incremental_regenerates_changed_chunks(browse_input, rendered):
+    generate_incremental(browse_input)
+    del rendered[:]
+    write_cdf(browse_input, changed=slice(150, 160))
+    generate_incremental(browse_input)
+    assert rendered == chunk_names(browse_input, [1])
+
+
+def test_incremental_resumes_after_chunk_error(
+        browse_input, rendered, monkeypatch):
+    render_chunk = generate_browse.render_chunk
+
+    def _failing_render_chunk(index, *args, **kwargs):
+        if index == 1:
+            raise IOError("disk full")
+        return render_chunk(index, *args, **kwargs)
+
+    monkeypatch.setattr(generate_browse, "render_chunk", _failing_render_chunk)
+    with pytest.raises(generate_browse.ChunkError):
+        generate_incremental(browse_input)
+    assert rendered == chunk_names(browse_input, [0])
+
+    monkeypatch.setattr(generate_browse, "render_chunk", render_chunk)
+    del rendered[:]
+    generate_incremental(browse_input)
+    assert rendered == chunk_names(browse_input, [1, 2])
+
+
+def test_sub_second_chunk_labels_are_unique(tmpdir):
+    filename = str(tmpdir.join(INPUT_FILENAME))
+    write_cdf(filename, size=20, sampling=0.1)
+    reader = generate_browse.ChunkReader(pycdf.CDF(filename))
+    labels = [label for label, _, _ in reader.time_bounds(
+        generate_browse.parse_interval("500ms")
+    )]
+    assert labels == [
+        "20160101T000000.000000", "20160101T000000.500000",
+        "20160101T000001.000000", "20160101T000001.500000",
+    ]
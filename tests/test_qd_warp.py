@@ -0,0 +1,114 @@
+""" Tests of the signed longitude line extraction. """
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("eoxmagmod")
+pytest.importorskip("fiona")
+pytest.importorskip("skimage")
+from affine import Affine
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "graticules"))
+import qd_warp
+
+# 1 degree pixels centred on whole degrees
+AFFINE = Affine(1., 0., -180.5, 0., -1., 90.5)
+
+
+def lon_array(offset=90.):
+    """ Longitude raster wrapping at x == -offset and x == 180 - offset. """
+    x = np.arange(-180., 181.)
+    lon = np.mod(x + offset + 180., 360.) - 180.
+    return np.tile(lon, (181, 1))
+
+
+def sample_point(array, x, y):
+    """ Bilinear point query of one vertex, None outside of the raster. """
+    col, row = ~AFFINE * (x, y)
+    col, row = col - 0.5, row - 0.5
+    col0, row0 = int(np.floor(col)), int(np.floor(row))
+    if not (
+        0 <= col0 < array.shape[1] - 1 and 0 <= row0 < array.shape[0] - 1
+    ):
+        return None
+    dx, dy = col - col0, row - row0
+    return (
+        array[row0, col0] * (1 - dx) * (1 - dy) +
+        array[row0, col0 + 1] * dx * (1 - dy) +
+        array[row0 + 1, col0] * (1 - dx) * dy +
+        array[row0 + 1, col0 + 1] * dx * dy
+    )
+
+
+def reference_split(line, array):
+    """ The previous per-vertex split as (dd, vertices) tuples. """
+    longitude = line["properties"]["dd"]
+    lines = []
+    current, positive = [], None
+    for x, y in line["geometry"]["coordinates"]:
+        value = sample_point(array, x, y)
+        if value is None:
+            continue
+        if not current:
+            positive = value >= 0.
+        current.append((x, y))
+        if (value >= 0.) != positive:
+            lines.append((longitude if positive else -longitude, current))
+            current = []
+    if current:
+        lines.append((longitude if positive else -longitude, current))
+    # single vertex lines were degenerate
+    return [(dd, coords) for dd, coords in lines if len(coords) >= 2]
+
+
+def zigzag(xs):
+    """ Contour crossing the raster with alternating latitudes. """
+    return {
+        "properties": {"dd": 150.},
+        "geometry": {"coordinates": [
+            (x, 10. * (-1) ** i) for i, x in enumerate(xs)]},
+    }
+
+
+def test_sample_bilinear_matches_point_query():
+    array = lon_array() + np.arange(181.)[:, None] / 7.
+    random = np.random.RandomState(0)
+    xs = random.uniform(-182., 182., 500)
+    ys = random.uniform(-92., 92., 500)
+    values = qd_warp._sample_bilinear(array, AFFINE, xs, ys)
+    for x, y, value in zip(xs, ys, values):
+        expected = sample_point(array, x, y)
+        if expected is None:
+            assert np.isnan(value)
+        else:
+            assert value == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("xs", [
+    np.linspace(-170., 170., 35),
+    np.linspace(170., -170., 35),
+    np.append(np.linspace(-179.75, 179.75, 80), [181., 182.]),
+    [-100., -95., -91., -89.5, -85., 85., 89.5, 91., 95.],
+])
+def test_split_points_match_previous_implementation(xs):
+    array = lon_array()
+    line = zigzag(xs)
+    expected = reference_split(line, array)
+    features = list(qd_warp._split_longitude(line, array, AFFINE))
+
+    assert len(features) == len(expected) > 1
+    for index, (feature, (dd, coords)) in enumerate(zip(features, expected)):
+        assert feature["properties"]["dd"] == dd
+        assert feature["properties"]["degrees"] == int(round(dd))
+        vertices = [tuple(v) for v in feature["geometry"]["coordinates"]]
+        # lines end at the first vertex of the opposite sign, which also
+        # starts the next line now
+        assert vertices[-1] == coords[-1]
+        if index:
+            assert vertices[1:] == coords
+        else:
+            assert vertices == coords
@@ -0,0 +1,59 @@
+""" Tests of the QD grid evaluation. """
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("eoxmagmod")
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "graticules"))
+import qdgrid
+import geometry
+
+POLE_LAT, POLE_LON = 80., -72.
+
+
+def rotated_pole(lat, lon, radius, decimal_year):
+    """ Stub QD model: coordinates relative to a tilted dipole pole. """
+    lat, lon = np.radians(lat), np.radians(lon)
+    vectors = np.stack((
+        np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+    angle_z, angle_y = np.radians(POLE_LON), np.radians(90. - POLE_LAT)
+    rotate_z = np.array([
+        [np.cos(angle_z), np.sin(angle_z), 0.],
+        [-np.sin(angle_z), np.cos(angle_z), 0.],
+        [0., 0., 1.],
+    ])
+    rotate_y = np.array([
+        [np.cos(angle_y), 0., -np.sin(angle_y)],
+        [0., 1., 0.],
+        [np.sin(angle_y), 0., np.cos(angle_y)],
+    ])
+    x, y, z = np.tensordot(rotate_y.dot(rotate_z), vectors, 1)
+    return (
+        np.degrees(np.arcsin(np.clip(z, -1., 1.))),
+        np.degrees(np.arctan2(y, x)),
+    )
+
+
+@pytest.fixture
+def stub_model(monkeypatch):
+    monkeypatch.setattr(qdgrid, "eval_qdlatlon", rotated_pole)
+    monkeypatch.setattr(qdgrid, "convert", lambda coords, *args: coords)
+
+
+@pytest.mark.parametrize("tolerance", [0.1, 0.01])
+def test_adaptive_grid_is_within_tolerance(stub_model, tolerance):
+    options = dict(
+        size_x=361, size_y=181, bounds=qdgrid.BOUNDS, elevation=0,
+        decimal_year=qdgrid.DECIMAL_YEAR)
+    qd_lat, qd_lon = qdgrid.eval_qd_grid(**options)
+    lat, lon = qdgrid.eval_qd_grid_adaptive(
+        tolerance=tolerance, coarse_step=16, **options)
+
+    assert np.abs(lat - qd_lat).max() <= tolerance
+    assert (
+        np.abs(geometry.wrap(lon - qd_lon)) * np.cos(np.radians(qd_lat))
+    ).max() <= tolerance
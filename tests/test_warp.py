@@ -0,0 +1,116 @@
+""" Tests of the geometry warping. """
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("eoxmagmod")
+pytest.importorskip("fiona")
+pytest.importorskip("scipy")
+from shapely.geometry import box, Polygon
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "graticules"))
+import warp
+import geometry
+
+
+def polar_cap(latitude, size=73):
+    """ Polygon of the cap north of latitude in longitude/latitude. """
+    return Polygon(
+        [(lon, latitude) for lon in np.linspace(-180, 180, size)] +
+        [(180, 90), (-180, 90)]
+    )
+
+
+def band(south, north, size=73):
+    """ Polygon of the band between two latitudes in longitude/latitude. """
+    return Polygon(
+        [(lon, south) for lon in np.linspace(-180, 180, size)] +
+        [(lon, north) for lon in np.linspace(180, -180, size)]
+    )
+
+
+@pytest.mark.parametrize("tolerance", [None, 0.1])
+def test_box_crossing_qd_antimeridian_is_valid(tolerance):
+    geom = warp.warp_geometry(box(90, 30, 130, 50), tolerance=tolerance)
+    assert geom.is_valid
+    assert not geom.is_empty
+
+
+@pytest.mark.parametrize("tolerance", [None, 0.1])
+def test_polar_cap_is_valid(tolerance):
+    geom = warp.warp_geometry(polar_cap(70), tolerance=tolerance)
+    assert geom.is_valid
+    assert geom.bounds[3] == 90.
+
+
+def test_inverse_oval_is_valid():
+    transform = warp.InverseWarper(size_x=181, size_y=91)
+    geom = warp.warp_geometry(band(65, 75), transform=transform)
+    assert geom.is_valid
+    assert not geom.is_empty
+
+
+def test_inverse_round_trip():
+    random = np.random.RandomState(0)
+    lat = np.concatenate((
+        np.degrees(np.arcsin(random.uniform(-1, 1, 1000))),
+        random.uniform(89., 90., 500), random.uniform(-90., -89., 500),
+        [90., -90.],
+    ))
+    lon = random.uniform(-180., 180., len(lat))
+    qd_lon, qd_lat = warp._magnetic_warp(lon, lat)
+
+    transform = warp.InverseWarper(size_x=181, size_y=91)
+    out_lon, out_lat = transform(qd_lon, qd_lat)
+
+    assert transform.unconverged == 0
+    # compare unit vectors as longitudes are arbitrary at the poles
+    error = np.degrees(np.arccos(np.clip(np.sum(
+        warp._unit_vectors(lon, lat) * warp._unit_vectors(out_lon, out_lat),
+        axis=1), -1., 1.)))
+    assert error.max() < 1e-4
+
+
+def wave(lon, lat):
+    """ Synthetic warp shifting latitudes along a sine of the longitude. """
+    lon = np.asarray(lon, dtype=float)
+    return lon, np.asarray(lat) + 10. * np.sin(np.radians(3. * lon + 20.))
+
+
+def test_densify_long_segment_within_tolerance():
+    source = np.array([[-80., 40.], [80., 40.]])
+    warped = warp._densify(
+        [source], [np.column_stack(wave(*source.T))], wave, 0.01,
+        max_depth=20)[0]
+
+    assert len(warped) > 2
+    # the source latitudes are recovered from the longitudes of the warp
+    lon = warped[:, 0]
+    lat = warped[:, 1] - 10. * np.sin(np.radians(3. * lon + 20.))
+    _, mid_lat = wave(
+        0.5 * (lon[:-1] + lon[1:]), 0.5 * (lat[:-1] + lat[1:]))
+    chord_lat = 0.5 * (warped[:-1, 1] + warped[1:, 1])
+    assert np.all(np.diff(lon) > 0)
+    assert np.abs(mid_lat - chord_lat).max() <= 0.01
+
+
+@pytest.mark.parametrize("max_depth", [0, 1, 3])
+def test_densify_stops_at_max_depth(max_depth):
+    source = np.array([[-80., 40.], [80., 40.]])
+    warped = warp._densify(
+        [source], [np.column_stack(wave(*source.T))], wave, 1e-9,
+        max_depth=max_depth)[0]
+
+    assert len(warped) == 2 ** max_depth + 1
+    assert np.allclose(warped[[0, -1]], np.column_stack(wave(*source.T)))
+
+
+def test_unwrap_keeps_rings_closed():
+    ring = np.array([[170., 0.], [-170., 1.], [-150., 0.], [170., 0.]])
+    out = geometry.unwrap_ring(ring)
+    assert tuple(out[-1]) == tuple(out[0])
+    assert np.all(np.abs(np.diff(out[:, 0])) < 180.)